@@ -0,0 +1,75 @@
+"""Benchmark decoding of a full set 17lands card ratings payload
+
+Compares the old path (stdlib json into dicts, schema inferred row by row by
+pl.DataFrame) with decode_rows. Reports mean parse time, peak Python heap
+during parsing and size of resulting DataFrame.
+
+Usage: python benchmarks/decode_card_ratings.py [payload.json]
+Without a payload file, MOM PremierDraft ratings are downloaded from 17lands.
+"""
+import json
+import sys
+import time
+import tracemalloc
+from datetime import date
+from typing import Callable
+
+import polars as pl
+
+from ragavan.common import format_date
+from ragavan.seventeen_lands import (
+    CARD_RATINGS_SCHEMA,
+    URL_CARD_RATINGS,
+    _fetch_bytes,
+    decode_rows,
+)
+
+ROUNDS = 20
+
+
+def _inferred(payload: bytes) -> pl.DataFrame:
+    return pl.DataFrame(json.loads(payload))
+
+
+def _declared(payload: bytes) -> pl.DataFrame:
+    return decode_rows(payload, CARD_RATINGS_SCHEMA)
+
+
+def _measure(name: str, decode: Callable[[bytes], pl.DataFrame], payload: bytes):
+    decode(payload)
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        data = decode(payload)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    tracemalloc.start()
+    decode(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:10} {elapsed * 1000:8.2f} ms  peak {peak / 2**20:6.2f} MiB"
+        f"  frame {data.estimated_size() / 2**20:6.2f} MiB  {data.shape}"
+    )
+
+
+def main():
+    """Run benchmark"""
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as file:
+            payload = file.read()
+    else:
+        payload = _fetch_bytes(
+            URL_CARD_RATINGS,
+            {
+                "expansion": "MOM",
+                "format": "PremierDraft",
+                "start_date": format_date(date(2023, 4, 18)),
+                "end_date": format_date(date(2023, 6, 20)),
+            },
+        )
+    print(f"payload {len(payload) / 2**10:.0f} KiB, {ROUNDS} rounds")
+    _measure("inferred", _inferred, payload)
+    _measure("declared", _declared, payload)
+
+
+if __name__ == "__main__":
+    main()
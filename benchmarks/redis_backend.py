@@ -0,0 +1,149 @@
+"""Check RedisBackend against a local stand-in server and measure lock contention
+
+The stand-in speaks the subset of Redis protocol used by RedisBackend and can
+delay every reply to simulate a remote server. Round trip of an entry is
+checked first (including zero lifetime, touch and delete), then cache hits on
+one thread are timed while another thread keeps requesting new entries, which
+are looked up in and written to the slow backend.
+
+Usage: python benchmarks/redis_backend.py [latency in ms]
+"""
+import itertools
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import polars as pl
+
+from ragavan.backends import RedisBackend
+from ragavan.storage import Storage
+
+ROUNDS = 200
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "_StandIn"
+
+    def _read_command(self) -> List[bytes]:
+        line = self.rfile.readline()
+        if not line:
+            return []
+        args = []
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def _reply(self, value: Any) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(map(self._reply, value))
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def handle(self) -> None:
+        while args := self._read_command():
+            time.sleep(self.server.latency)
+            name, key, *rest = args
+            hashes = self.server.hashes
+            with self.server.lock:
+                match name.upper():
+                    case b"SELECT" | b"PERSIST" | b"PEXPIREAT":
+                        reply: Any = "OK" if name.upper() == b"SELECT" else 1
+                    case b"HSET":
+                        fields = hashes.setdefault(key, {})
+                        fields.update(zip(rest[::2], rest[1::2]))
+                        reply = len(rest) // 2
+                    case b"HMGET":
+                        reply = [hashes.get(key, {}).get(field) for field in rest]
+                    case b"EXISTS":
+                        reply = int(key in hashes)
+                    case b"DEL":
+                        reply = int(hashes.pop(key, None) is not None)
+                    case _:
+                        reply = None
+            self.wfile.write(self._reply(reply))
+
+
+class _StandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self, latency: float) -> None:
+        super().__init__(("localhost", 0), _Handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+
+
+def _check_round_trip(backend: RedisBackend) -> None:
+    data = pl.DataFrame({"name": ["Ragavan"], "games": [1]})
+    timestamp = datetime.now().replace(microsecond=0)
+    backend.write("card_ratings", "zero", data, timestamp, timedelta(0))
+    entry = backend.entry("card_ratings", "zero")
+    assert entry is not None and entry.lifetime == timedelta(0), entry
+    assert entry.loader().frame_equal(data)
+    backend.touch("card_ratings", "zero", timestamp, None)
+    entry = backend.entry("card_ratings", "zero")
+    assert entry is not None and entry.lifetime is None, entry
+    backend.delete("card_ratings", "zero")
+    assert backend.entry("card_ratings", "zero") is None
+    print("round trip ok")
+
+
+def _hit_times(storage: Storage, cold: bool) -> Tuple[float, float]:
+    """Return mean and worst time of cache hit, optionally with cold lookups
+    running on another thread"""
+    storage._get("play_draw", "hot", lambda: pl.DataFrame({"x": [1]}))
+    started = threading.Event()
+    running = threading.Event()
+    running.set()
+
+    def look_up_cold() -> None:
+        started.set()
+        for index in itertools.count():
+            if not running.is_set():
+                return
+            storage._get("play_draw", f"cold-{index}", pl.DataFrame)
+
+    thread = threading.Thread(target=look_up_cold, daemon=True)
+    if cold:
+        thread.start()
+        started.wait()
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        storage._get("play_draw", "hot", lambda: pl.DataFrame({"x": [1]}))
+        times.append(time.perf_counter() - start)
+        # let the other thread run
+        time.sleep(0.001)
+    running.clear()
+    if cold:
+        thread.join()
+    return (sum(times) / ROUNDS, max(times))
+
+
+def main():
+    """Run checks"""
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.005
+    server = _StandIn(latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    backend = RedisBackend("localhost", server.server_address[1])
+    _check_round_trip(backend)
+    storage = Storage(backend, write_delay=None)
+    print(f"backend latency {latency * 1000:.1f} ms, {ROUNDS} hits")
+    for cold in (False, True):
+        mean, worst = _hit_times(storage, cold)
+        label = "with cold lookups" if cold else "alone"
+        print(f"hit {label:18} {mean * 1000:8.3f} ms  worst {worst * 1000:8.3f} ms")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+/* Highlighting of selected cards in card ratings graph, done in browser so
+   changing selection doesn't rebuild the graph on server */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    card_ratings: {
+        highlight: function (figure, selected) {
+            if (!figure || !figure.data.length) {
+                return [{}, { display: "none" }];
+            }
+            const chosen = new Set(selected || []);
+            const legend = figure.data.find((trace) => trace.name === "selected");
+            const data = figure.data.map((trace) =>
+                trace === legend
+                    ? trace
+                    : {
+                          ...trace,
+                          marker: {
+                              ...trace.marker,
+                              color: trace.y.map((name) =>
+                                  chosen.has(name)
+                                      ? legend.marker.color
+                                      : trace.marker.color
+                              ),
+                          },
+                      }
+            );
+            return [{ ...figure, data: data }, {}];
+        },
+    },
+});
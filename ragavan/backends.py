@@ -0,0 +1,591 @@
+"""Persistent backends for cached 17lands data"""
+import hashlib
+import io
+import os
+import socket
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from functools import partial
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+import orjson
+import polars as pl
+from platformdirs import user_cache_path
+
+from ragavan.common import format_date, parse_date
+
+log = getLogger("backends")
+
+DEFAULT_PATH = user_cache_path("ragavan", "AcidBishop") / "cache"
+
+
+Item = Tuple[str, str, Any, datetime, Optional[timedelta]]
+# cache, key, new timestamp and lifetime of entry
+Touch = Tuple[str, str, datetime, Optional[timedelta]]
+
+
+class Entry(NamedTuple):
+    """Metadata of persisted cache entry and function reading its data"""
+
+    timestamp: datetime
+    lifetime: Optional[timedelta]
+    loader: Callable[[], Any]
+
+
+def _lifetime_seconds(lifetime: Optional[timedelta]) -> Optional[float]:
+    return None if lifetime is None else lifetime.total_seconds()
+
+
+def _parse_lifetime(seconds: Optional[float]) -> Optional[timedelta]:
+    return None if seconds is None else timedelta(seconds=seconds)
+
+
+def encode(data: Any) -> Tuple[str, bytes]:
+    """Serialize data, return format used and serialized bytes"""
+    if isinstance(data, pl.DataFrame):
+        buffer = io.BytesIO()
+        data.write_ipc(buffer)
+        return ("ipc", buffer.getvalue())
+    if isinstance(data, date):
+        return ("date", orjson.dumps(format_date(data)))
+    return ("json", orjson.dumps(data))
+
+
+def decode(data_format: str, payload: bytes) -> Any:
+    """Deserialize data serialized by encode"""
+    match data_format:
+        case "ipc":
+            return pl.read_ipc(io.BytesIO(payload))
+        case "date":
+            return parse_date(orjson.loads(payload))
+        case _:
+            return orjson.loads(payload)
+
+
+class Backend:
+    """Persistent store of cache entries
+
+    Entries are identified by cache name and key. Backends don't check validity
+    of entries, they only store their timestamp and lifetime.
+    """
+
+    def entries(self) -> Iterable[Tuple[str, str, Entry]]:
+        """Return entries known at startup"""
+        return ()
+
+    def entry(self, cache: str, key: str) -> Optional[Entry]:
+        """Return single entry or None if it's not stored"""
+        raise NotImplementedError
+
+    def write(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Optional[Callable[[], Any]]:
+        """Store entry, return function reading it back or None if it can't be"""
+        raise NotImplementedError
+
+    def write_many(self, items: List[Item]) -> List[Optional[Callable[[], Any]]]:
+        """Store many entries given as (cache, key, data, timestamp, lifetime)"""
+        return [self.write(*item) for item in items]
+
+    def write_batch(
+        self,
+        items: List[Item],
+        touched: List[Touch],
+        deleted: List[Tuple[str, str]],
+    ) -> List[Optional[Callable[[], Any]]]:
+        """Store, touch and delete entries together, see write_many"""
+        loaders = self.write_many(items) if items else []
+        for touch in touched:
+            self.touch(*touch)
+        for cache, key in deleted:
+            self.delete(cache, key)
+        return loaders
+
+    def touch(
+        self,
+        cache: str,
+        key: str,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> None:
+        """Change timestamp and lifetime of stored entry without writing its data"""
+        raise NotImplementedError
+
+    def delete(self, cache: str, key: str) -> None:
+        """Remove entry"""
+        raise NotImplementedError
+
+
+class MemoryBackend(Backend):
+    """Backend persisting nothing, data lives only in memory of the process"""
+
+    def entry(self, cache: str, key: str) -> Optional[Entry]:
+        return None
+
+    def write(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Optional[Callable[[], Any]]:
+        return None
+
+    def touch(
+        self,
+        cache: str,
+        key: str,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> None:
+        pass
+
+    def delete(self, cache: str, key: str) -> None:
+        pass
+
+
+def _tmp_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _load_file(path: Path, data_format: str) -> Any:
+    if data_format == "ipc":
+        return pl.read_ipc(path, memory_map=True)
+    return decode(data_format, path.read_bytes())
+
+
+class FileBackend(Backend):
+    """Backend storing every entry in its own file
+
+    DataFrames are written as Arrow IPC files and memory-mapped when read,
+    everything else is written as JSON. Files are described by a small index
+    holding keys, timestamps and lifetimes, replaced atomically on every change.
+    Only one process should use given directory.
+    """
+
+    def __init__(self, path: Path = DEFAULT_PATH) -> None:
+        self.path = path
+        self._index: dict[str, dict[str, dict]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self) -> Path:
+        """Path of the cache index file"""
+        return self.path / "index.json"
+
+    def _entry(self, record: dict) -> Entry:
+        return Entry(
+            datetime.fromisoformat(record["timestamp"]),
+            _parse_lifetime(record["lifetime"]),
+            partial(_load_file, self.path / record["file"], record["format"]),
+        )
+
+    def entries(self) -> Iterable[Tuple[str, str, Entry]]:
+        try:
+            index = orjson.loads(self.index_path.read_bytes())
+        except (OSError, ValueError):
+            log.info("No readable cache index in %s", self.path)
+            return []
+        with self._lock:
+            self._index = index
+        return [
+            (cache, key, self._entry(record))
+            for cache, records in index.items()
+            for key, record in records.items()
+        ]
+
+    def entry(self, cache: str, key: str) -> Optional[Entry]:
+        with self._lock:
+            record = self._index.get(cache, {}).get(key)
+        return self._entry(record) if record else None
+
+    def _save_index(self) -> None:
+        tmp = _tmp_path(self.index_path)
+        tmp.write_bytes(orjson.dumps(self._index))
+        os.replace(tmp, self.index_path)
+
+    def _write_file(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Callable[[], Any]:
+        """Write entry file and add it to index without saving it"""
+        name = f"{cache}-{hashlib.sha1(key.encode()).hexdigest()}"
+        if isinstance(data, pl.DataFrame):
+            path = self.path / f"{name}.arrow"
+            tmp = _tmp_path(path)
+            data.write_ipc(tmp)
+            data_format = "ipc"
+        else:
+            path = self.path / f"{name}.json"
+            tmp = _tmp_path(path)
+            data_format, payload = encode(data)
+            tmp.write_bytes(payload)
+        os.replace(tmp, path)
+        with self._lock:
+            self._index.setdefault(cache, {})[key] = {
+                "file": path.name,
+                "format": data_format,
+                "timestamp": timestamp.isoformat(),
+                "lifetime": _lifetime_seconds(lifetime),
+            }
+        return partial(_load_file, path, data_format)
+
+    def write(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Optional[Callable[[], Any]]:
+        return self.write_many([(cache, key, data, timestamp, lifetime)])[0]
+
+    def write_many(self, items: List[Item]) -> List[Optional[Callable[[], Any]]]:
+        return self.write_batch(items, [], [])
+
+    def write_batch(
+        self,
+        items: List[Item],
+        touched: List[Touch],
+        deleted: List[Tuple[str, str]],
+    ) -> List[Optional[Callable[[], Any]]]:
+        """Apply whole batch to index and save it once"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        loaders = [self._write_file(*item) for item in items]
+        with self._lock:
+            changed = bool(items)
+            for cache, key, timestamp, lifetime in touched:
+                record = self._index.get(cache, {}).get(key)
+                if record:
+                    record["timestamp"] = timestamp.isoformat()
+                    record["lifetime"] = _lifetime_seconds(lifetime)
+                    changed = True
+            for cache, key in deleted:
+                record = self._index.get(cache, {}).pop(key, None)
+                if record:
+                    (self.path / record["file"]).unlink(missing_ok=True)
+                    changed = True
+            if changed:
+                self._save_index()
+        return loaders
+
+    def touch(
+        self,
+        cache: str,
+        key: str,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> None:
+        self.write_batch([], [(cache, key, timestamp, lifetime)], [])
+
+    def delete(self, cache: str, key: str) -> None:
+        self.write_batch([], [], [(cache, key)])
+
+
+class SQLiteBackend(Backend):
+    """Backend storing entries as serialized blobs in SQLite database
+
+    Database runs in WAL mode, so it can be shared by many processes on one host.
+    """
+
+    def __init__(self, path: Path = DEFAULT_PATH / "cache.sqlite3") -> None:
+        self.path = path
+        self._local = threading.local()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "cache TEXT, key TEXT, format TEXT, timestamp TEXT, lifetime REAL, "
+                "data BLOB, PRIMARY KEY (cache, key))"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+        return self._local.connection
+
+    def _read(self, cache: str, key: str) -> Any:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT format, data FROM entries WHERE cache = ? AND key = ?",
+                (cache, key),
+            )
+            .fetchone()
+        )
+        if row is None:
+            raise KeyError(f"{cache} {key}")
+        return decode(*row)
+
+    def _entry(self, cache: str, key: str, timestamp: str, lifetime: float) -> Entry:
+        return Entry(
+            datetime.fromisoformat(timestamp),
+            _parse_lifetime(lifetime),
+            partial(self._read, cache, key),
+        )
+
+    def entries(self) -> Iterable[Tuple[str, str, Entry]]:
+        rows = self._connection().execute(
+            "SELECT cache, key, timestamp, lifetime FROM entries"
+        )
+        return [
+            (cache, key, self._entry(cache, key, *rest)) for cache, key, *rest in rows
+        ]
+
+    def entry(self, cache: str, key: str) -> Optional[Entry]:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT timestamp, lifetime FROM entries WHERE cache = ? AND key = ?",
+                (cache, key),
+            )
+            .fetchone()
+        )
+        return self._entry(cache, key, *row) if row else None
+
+    def write(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Optional[Callable[[], Any]]:
+        return self.write_many([(cache, key, data, timestamp, lifetime)])[0]
+
+    def write_many(self, items: List[Item]) -> List[Optional[Callable[[], Any]]]:
+        rows = [
+            (
+                cache,
+                key,
+                *encode(data),
+                timestamp.isoformat(),
+                _lifetime_seconds(lifetime),
+            )
+            for cache, key, data, timestamp, lifetime in items
+        ]
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO entries (cache, key, format, data, timestamp, "
+                "lifetime) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return [partial(self._read, cache, key) for cache, key, *_ in items]
+
+    def touch(
+        self,
+        cache: str,
+        key: str,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> None:
+        with self._connection() as connection:
+            connection.execute(
+                "UPDATE entries SET timestamp = ?, lifetime = ? "
+                "WHERE cache = ? AND key = ?",
+                (timestamp.isoformat(), _lifetime_seconds(lifetime), cache, key),
+            )
+
+    def delete(self, cache: str, key: str) -> None:
+        with self._connection() as connection:
+            connection.execute(
+                "DELETE FROM entries WHERE cache = ? AND key = ?", (cache, key)
+            )
+
+
+class RedisError(Exception):
+    """Error reply from Redis server"""
+
+
+class _RedisConnection:
+    """Minimal client of Redis serialization protocol"""
+
+    def __init__(self, host: str, port: int, db: int, timeout: float) -> None:
+        self._socket = socket.create_connection((host, port), timeout)
+        self._file = self._socket.makefile("rb")
+        if db:
+            self.command("SELECT", db)
+
+    def command(self, *args: Any) -> Any:
+        """Send command and return its reply"""
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self._socket.sendall(b"".join(parts))
+        return self._reply()
+
+    def _reply(self) -> Any:
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, value = line[:1], line[1:-2]
+        match kind:
+            case b"+":
+                return value
+            case b"-":
+                raise RedisError(value.decode())
+            case b":":
+                return int(value)
+            case b"$":
+                if int(value) < 0:
+                    return None
+                return self._file.read(int(value) + 2)[:-2]
+            case b"*":
+                if int(value) < 0:
+                    return None
+                return [self._reply() for _ in range(int(value))]
+            case _:
+                raise RedisError(f"Unexpected reply {line!r}")
+
+
+class RedisBackend(Backend):
+    """Backend storing entries as hashes in Redis (or any server speaking its protocol)
+
+    Entries with limited lifetime are expired by the server itself, grace period
+    after their lifetime ends, so they can still be served stale. Nothing is read
+    at startup, entries are looked up on demand.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        prefix: str = "ragavan",
+        timeout: float = 5,
+        grace: timedelta = timedelta(days=1),
+    ) -> None:
+        self._address = (host, port, db, timeout)
+        self.prefix = prefix
+        self.grace = grace
+        self._local = threading.local()
+
+    def _command(self, *args: Any) -> Any:
+        if not hasattr(self._local, "connection"):
+            self._local.connection = _RedisConnection(*self._address)
+        try:
+            return self._local.connection.command(*args)
+        except OSError:
+            del self._local.connection
+            raise
+
+    def _key(self, cache: str, key: str) -> str:
+        return f"{self.prefix}:{cache}:{key}"
+
+    def _read(self, cache: str, key: str) -> Any:
+        data_format, payload = self._command(
+            "HMGET", self._key(cache, key), "format", "data"
+        )
+        if payload is None:
+            raise KeyError(f"{cache} {key}")
+        return decode(data_format.decode(), payload)
+
+    def entry(self, cache: str, key: str) -> Optional[Entry]:
+        timestamp, lifetime = self._command(
+            "HMGET", self._key(cache, key), "timestamp", "lifetime"
+        )
+        if timestamp is None:
+            return None
+        return Entry(
+            datetime.fromisoformat(timestamp.decode()),
+            _parse_lifetime(float(lifetime) if lifetime else None),
+            partial(self._read, cache, key),
+        )
+
+    def write(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> Optional[Callable[[], Any]]:
+        data_format, payload = encode(data)
+        name = self._key(cache, key)
+        self._command(
+            "HSET",
+            name,
+            "format",
+            data_format,
+            "timestamp",
+            timestamp.isoformat(),
+            "lifetime",
+            "" if lifetime is None else lifetime.total_seconds(),
+            "data",
+            payload,
+        )
+        self._expire(name, timestamp, lifetime)
+        return partial(self._read, cache, key)
+
+    def _expire(self, name: str, timestamp: datetime, lifetime: Optional[timedelta]):
+        if lifetime is None:
+            self._command("PERSIST", name)
+        else:
+            expires = timestamp + lifetime + self.grace
+            self._command("PEXPIREAT", name, int(expires.timestamp() * 1000))
+
+    def touch(
+        self,
+        cache: str,
+        key: str,
+        timestamp: datetime,
+        lifetime: Optional[timedelta],
+    ) -> None:
+        name = self._key(cache, key)
+        if not self._command("EXISTS", name):
+            return
+        self._command(
+            "HSET",
+            name,
+            "timestamp",
+            timestamp.isoformat(),
+            "lifetime",
+            "" if lifetime is None else lifetime.total_seconds(),
+        )
+        self._expire(name, timestamp, lifetime)
+
+    def delete(self, cache: str, key: str) -> None:
+        self._command("DEL", self._key(cache, key))
+
+
+def backend_from_url(url: Optional[str]) -> Backend:
+    """Create backend described by url
+
+    Supported values are "memory", "file" or "file:///path/to/directory",
+    "sqlite" or "sqlite:///path/to/database" and "redis://host:port/db".
+    """
+    parts = urlsplit(url or "file")
+    scheme = parts.scheme or parts.path
+    path = Path(parts.path) if parts.scheme and parts.path else None
+    match scheme:
+        case "memory":
+            return MemoryBackend()
+        case "file":
+            return FileBackend(path) if path else FileBackend()
+        case "sqlite":
+            return SQLiteBackend(path) if path else SQLiteBackend()
+        case "redis":
+            return RedisBackend(
+                parts.hostname or "localhost",
+                parts.port or 6379,
+                int(parts.path.strip("/") or 0),
+            )
+        case _:
+            raise ValueError(f"Unknown cache backend {url}")
@@ -0,0 +1,724 @@
+"""Thread-safe cache of downloaded data persisted by backend"""
+import atexit
+import heapq
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import count
+from logging import getLogger
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import polars as pl
+
+from ragavan.backends import Backend, Entry, FileBackend
+from ragavan.seventeen_lands import (
+    NotModified,
+    Priority,
+    Urgency,
+    current_priority,
+    priority,
+    revalidation,
+)
+
+log = getLogger("cache")
+
+DEFAULT_MEMORY_BUDGET = 512 * 2**20
+DEFAULT_WRITE_DELAY = timedelta(seconds=5)
+DEFAULT_MAX_STALE = timedelta(days=1)
+REFRESH_WORKERS = 2
+
+Lifetime = Union[Optional[timedelta], Callable[[Any], Optional[timedelta]]]
+_versions = count()
+
+
+def _download_one(download: Callable[[List[int]], List[Any]], index: int) -> Any:
+    return download([index])[0]
+
+
+class StorageCell:
+    """Cell holding any data and its time of validity
+
+    Data may be given directly or as a loader called on first access. Cells
+    with a loader may drop their data from memory and read it again later.
+    Every cell gets unique version, so readers can tell if an entry was
+    replaced without keeping its cell.
+    """
+
+    def __init__(
+        self,
+        data: Any = None,
+        lifetime: Optional[timedelta] = timedelta(days=1),
+        timestamp: Optional[datetime] = None,
+        loader: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        self._data = data
+        self.loader = loader
+        self.loaded = loader is None
+        self.timestamp = timestamp or datetime.now()
+        self.lifetime = lifetime
+        self.version = next(_versions)
+
+    @property
+    def data(self) -> Any:
+        """Data held by this cell, loaded from disk if not read yet"""
+        self.load()
+        return self._data
+
+    def load(self) -> None:
+        """Load data into memory if not loaded yet"""
+        if not self.loaded:
+            self._data = self.loader()
+            self.loaded = True
+
+    def unload(self) -> bool:
+        """Drop data from memory if it can be loaded again, return if it was dropped"""
+        if not self.loader or not self.loaded:
+            return False
+        self._data = None
+        self.loaded = False
+        return True
+
+    @property
+    def size(self) -> int:
+        """Estimated size of data held in memory in bytes"""
+        if self.loaded and isinstance(self._data, pl.DataFrame):
+            return self._data.estimated_size()
+        return 0
+
+    @property
+    def expires(self) -> Optional[datetime]:
+        """Time when data held by this cell expires, None if it never does"""
+        if self.lifetime is None:
+            return None
+        return self.timestamp + self.lifetime
+
+    def valid(self) -> bool:
+        """Checks if data held by this cell is valid"""
+        expires = self.expires
+        return expires is None or datetime.now() < expires
+
+
+# versions of cells read by key, None if entry wasn't cached
+Reads = Dict[Tuple[str, str], Optional[int]]
+_reads: ContextVar[Optional[Reads]] = ContextVar("reads", default=None)
+# cells found in backend by key and cells whose data couldn't be read
+BackendRead = Tuple[Dict[str, StorageCell], Set[StorageCell]]
+
+
+class Cache:
+    """Thread-safe caching and persisting system for downloaded data"""
+
+    caches: Tuple[str, ...] = ("validators",)
+    revalidated: Tuple[str, ...] = ()
+
+    def __init__(
+        self,
+        backend: Optional[Backend] = None,
+        memory_budget: Optional[int] = DEFAULT_MEMORY_BUDGET,
+        write_delay: Optional[timedelta] = DEFAULT_WRITE_DELAY,
+        max_stale: Optional[timedelta] = DEFAULT_MAX_STALE,
+    ) -> None:
+        self._caches: Dict[str, Dict[str, StorageCell]] = {
+            cache: {} for cache in self.caches
+        }
+        self.backend = backend or FileBackend()
+        self.memory_budget = memory_budget
+        self._expiry: List[Tuple[datetime, str, str]] = []
+        self._resident: OrderedDict[Tuple[str, str], int] = OrderedDict()
+        self.evictions: Counter[str] = Counter()
+        self._lock = threading.RLock()
+        self._inflight: Dict[Tuple[str, str], Future] = {}
+        # priority of in-flight downloads, raised by callers waiting for them
+        self._urgencies: Dict[Tuple[str, str], Urgency] = {}
+        self._deleted: List[Tuple[str, str]] = []
+        self._touched: Dict[Tuple[str, str], Tuple[datetime, Optional[timedelta]]] = {}
+        self.coalesced: Counter[str] = Counter()
+        self.write_delay = write_delay
+        self._dirty: Dict[Tuple[str, str], StorageCell] = {}
+        self._dirty_added = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self.max_stale = max_stale
+        self.stale_served: Counter[str] = Counter()
+        self.not_modified: Counter[str] = Counter()
+        self._refresher = ThreadPoolExecutor(
+            REFRESH_WORKERS, thread_name_prefix="storage-refresh"
+        )
+
+    @property
+    def memory_usage(self) -> int:
+        """Estimated size of DataFrames held in memory in bytes"""
+        return sum(self._resident.values())
+
+    def flush(self) -> None:
+        """Persist all writes, touches and deletes waiting for background writer"""
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                touched, self._touched = self._touched, {}
+                deleted, self._deleted = self._deleted, []
+                # entries stored again since are in dirty
+                deleted = [
+                    (cache, key)
+                    for cache, key in dict.fromkeys(deleted)
+                    if key not in self._caches[cache]
+                ]
+            if not (dirty or touched or deleted):
+                return
+            log.info(
+                "Persisting %d entries, touching %d, deleting %d",
+                len(dirty),
+                len(touched),
+                len(deleted),
+            )
+            loaders = self.backend.write_batch(
+                [
+                    (cache, key, cell.data, cell.timestamp, cell.lifetime)
+                    for (cache, key), cell in dirty.items()
+                ],
+                [
+                    (cache, key, timestamp, lifetime)
+                    for (cache, key), (timestamp, lifetime) in touched.items()
+                    if (cache, key) not in dirty
+                ],
+                deleted,
+            )
+            with self._lock:
+                for ((cache, key), cell), loader in zip(dirty.items(), loaders):
+                    cell.loader = loader
+                    # entry was purged while being written
+                    if (
+                        key not in self._caches[cache]
+                        and (cache, key) not in self._dirty
+                    ):
+                        self._deleted.append((cache, key))
+                if self._deleted and self.write_delay is not None:
+                    self._wake_writer()
+            if self.write_delay is None:
+                self._delete_discarded()
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._lock:
+                while not (self._dirty or self._touched or self._deleted):
+                    self._dirty_added.wait()
+            time.sleep(self.write_delay.total_seconds())
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("Persisting storage failed")
+
+    def _mark_dirty(self, cache: str, key: str) -> None:
+        """Queue entry for background writer, starting it if needed"""
+        self._dirty[cache, key] = self._caches[cache][key]
+        self._wake_writer()
+
+    def _wake_writer(self) -> None:
+        """Notify background writer of queued work, starting it if needed"""
+        self._dirty_added.notify()
+        if self._writer is None:
+            self._writer = threading.Thread(
+                target=self._write_behind, name="storage-writer", daemon=True
+            )
+            self._writer.start()
+            atexit.register(self.flush)
+
+    @classmethod
+    def load(cls, lazy: bool = True, **kwargs: Any) -> "Cache":
+        """Instantiate new cache object with entries known to backend
+
+        In lazy mode only the index is read and every entry is mapped from disk
+        the first time it is requested.
+        """
+        log.info("Loading cache")
+        cache_ = cls(**kwargs)
+        cache_.load_index(lazy)
+        return cache_
+
+    def load_index(self, lazy: bool = True) -> None:
+        """Read entries known to backend at startup"""
+        for cache, key, entry in self.backend.entries():
+            if cache not in self._caches:
+                continue
+            cell = self._cell(entry)
+            if not lazy:
+                try:
+                    cell.load()
+                except (OSError, KeyError, ValueError):
+                    log.warning("Unreadable cache entry %s %s", cache, key)
+                    continue
+            with self._lock:
+                self._caches[cache][key] = cell
+                self._schedule(cache, key)
+                if not lazy:
+                    self._touch(cache, key)
+
+    @staticmethod
+    def _cell(entry: Entry) -> StorageCell:
+        return StorageCell(
+            lifetime=entry.lifetime, timestamp=entry.timestamp, loader=entry.loader
+        )
+
+    def _lookup(self, cache: str, key: str) -> Optional[StorageCell]:
+        """Return cell with its data loaded or None if not cached
+
+        Must be called without holding the lock, see _read_backend.
+        """
+        read = self._read_backend(cache, [key])
+        with self._lock:
+            cell = self._install(cache, key, read)
+        self._delete_discarded()
+        return cell
+
+    def _read_backend(self, cache: str, keys: List[str]) -> BackendRead:
+        """Look up entries missing in memory in backend and load data of cells
+
+        Backend is read without holding the lock, so a slow or remote backend
+        doesn't block other threads. Result is passed to _install.
+        """
+        with self._lock:
+            cells = {key: self._caches[cache].get(key) for key in keys}
+            downloading = {key for key in keys if (cache, key) in self._inflight}
+        found = {}
+        unreadable = set()
+        for key, cell in cells.items():
+            if cell is None:
+                if key in downloading:
+                    continue
+                entry = self.backend.entry(cache, key)
+                if entry is None:
+                    continue
+                cell = found[key] = self._cell(entry)
+            if cell.loaded or not (cell.valid() or self._servable(cell)):
+                continue
+            try:
+                cell.load()
+            except (OSError, KeyError, ValueError):
+                log.warning("Unreadable cache entry %s %s", cache, key)
+                unreadable.add(cell)
+        return (found, unreadable)
+
+    def _install(
+        self, cache: str, key: str, read: BackendRead
+    ) -> Optional[StorageCell]:
+        """Return servable cell of entry or None, adding cell read from backend
+
+        Cell stored by another thread since backend was read takes precedence.
+        Must be called with the lock held.
+        """
+        found, unreadable = read
+        cell = self._caches[cache].get(key)
+        if cell is None and key in found:
+            cell = self._caches[cache][key] = found[key]
+            self._schedule(cache, key)
+        if cell is None:
+            return None
+        if not cell.valid() and not self._servable(cell):
+            self._discard(cache, key)
+            return None
+        if cell in unreadable:
+            self._discard(cache, key)
+            return None
+        if not cell.loaded:
+            # dropped from memory since it was read, rare enough to load here
+            try:
+                cell.load()
+            except (OSError, KeyError, ValueError):
+                log.warning("Unreadable cache entry %s %s", cache, key)
+                self._discard(cache, key)
+                return None
+        self._touch(cache, key)
+        return cell
+
+    def _touch(self, cache: str, key: str) -> None:
+        """Mark entry as most recently used and enforce memory budget"""
+        size = self._caches[cache][key].size
+        if not size:
+            return
+        self._resident[cache, key] = size
+        self._resident.move_to_end((cache, key))
+        if self.memory_budget is None:
+            return
+        usage = self.memory_usage
+        for lru_cache, lru_key in list(self._resident.keys()):
+            if usage <= self.memory_budget or (lru_cache, lru_key) == (cache, key):
+                break
+            if self._caches[lru_cache][lru_key].unload():
+                log.info("Evicting %s %s from memory", lru_cache, lru_key)
+                usage -= self._resident.pop((lru_cache, lru_key))
+                self.evictions[lru_cache] += 1
+
+    def _discard(self, cache: str, key: str) -> None:
+        """Remove entry from memory, backend is cleaned by _delete_discarded"""
+        del self._caches[cache][key]
+        self._resident.pop((cache, key), None)
+        if self._dirty.pop((cache, key), None) is None:
+            self._deleted.append((cache, key))
+        if cache in self.revalidated and f"{cache}/{key}" in self._caches["validators"]:
+            self._discard("validators", f"{cache}/{key}")
+
+    def _delete_discarded(self) -> None:
+        """Delete discarded entries from backend, must be called without the lock
+
+        With write delay the deletes are left to the background writer.
+        """
+        with self._lock:
+            if self.write_delay is not None:
+                if self._deleted:
+                    self._wake_writer()
+                return
+            deleted, self._deleted = self._deleted, []
+        for cache, key in deleted:
+            with self._lock:
+                # entry may have been stored again since
+                if key in self._caches[cache]:
+                    continue
+            self.backend.delete(cache, key)
+
+    def _removal(self, cell: StorageCell) -> Optional[datetime]:
+        """Time when cell can no longer be served, even as stale"""
+        if cell.expires is None:
+            return None
+        return cell.expires + (self.max_stale or timedelta())
+
+    def _servable(self, cell: StorageCell) -> bool:
+        """Checks if expired cell may still be served while it is refreshed"""
+        return datetime.now() < self._removal(cell)
+
+    def _schedule(self, cache: str, key: str) -> None:
+        """Register removal time of entry"""
+        removal = self._removal(self._caches[cache][key])
+        if removal is not None:
+            heapq.heappush(self._expiry, (removal, cache, key))
+
+    def purge(self) -> None:
+        """Remove all data which can't be served anymore from cache"""
+        now = datetime.now()
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                removal, cache, key = heapq.heappop(self._expiry)
+                cell = self._caches[cache].get(key)
+                # entry may have been replaced or removed since it was scheduled
+                if cell and self._removal(cell) == removal:
+                    self._discard(cache, key)
+        self._delete_discarded()
+
+    def _store(
+        self,
+        cache: str,
+        key: str,
+        data: Any,
+        lifetime: Optional[timedelta] = timedelta(days=1),
+    ) -> Any:
+        self._caches[cache][key] = StorageCell(data, lifetime)
+        self._schedule(cache, key)
+        self._touch(cache, key)
+        return data
+
+    def _persist(self, cache: str, keys: List[str]) -> None:
+        """Persist freshly stored entries in one batch, called without the lock"""
+        with self._lock:
+            if self.write_delay is not None:
+                for key in keys:
+                    self._mark_dirty(cache, key)
+                return
+            cells = [self._caches[cache][key] for key in keys]
+        log.info("Persisting %d %s entries", len(keys), cache)
+        loaders = self.backend.write_many(
+            [
+                (cache, key, cell.data, cell.timestamp, cell.lifetime)
+                for key, cell in zip(keys, cells)
+            ]
+        )
+        for cell, loader in zip(cells, loaders):
+            cell.loader = loader
+
+    def _get(
+        self,
+        cache: str,
+        key: str,
+        download: Callable[[], Any],
+        lifetime: Lifetime = timedelta(days=1),
+    ) -> Any:
+        """Return cached data or download it, see _get_many"""
+        return self._get_many(cache, [key], lambda indexes: [download()], [lifetime])[0]
+
+    def _get_many(
+        self,
+        cache: str,
+        keys: List[str],
+        download: Callable[[List[int]], List[Any]],
+        lifetimes: List[Lifetime],
+    ) -> List[Any]:
+        """Return cached data for many keys, downloading missing ones in one batch"""
+        results: List[Any] = [None] * len(keys)
+        leading, waiting = self._claim(cache, keys, download, lifetimes, results)
+        # raise priority of all awaited downloads before blocking on any of them
+        for _, _, urgency in waiting:
+            urgency.raise_to(current_priority())
+        if leading:
+            downloaded = self._download(
+                cache,
+                [keys[index] for index in leading],
+                partial(download, leading),
+                [lifetimes[index] for index in leading],
+            )
+            for index, data in zip(leading, downloaded):
+                results[index] = data
+        for index, future, _ in waiting:
+            results[index] = future.result()
+        self._record_reads(cache, keys)
+        return results
+
+    def _claim(
+        self,
+        cache: str,
+        keys: List[str],
+        download: Callable[[List[int]], List[Any]],
+        lifetimes: List[Lifetime],
+        results: List[Any],
+    ) -> Tuple[List[int], List[Tuple[int, Future, Urgency]]]:
+        """Fill results with cached data, see _get_many
+
+        Returns indexes of keys the caller has to download and, for keys
+        downloaded by others, their futures and priority of their download.
+        """
+        leading: List[int] = []
+        waiting: List[Tuple[int, Future, Urgency]] = []
+        urgency = Urgency(current_priority())
+        self.purge()
+        read = self._read_backend(cache, keys)
+        with self._lock:
+            for index, key in enumerate(keys):
+                cell = self._install(cache, key, read)
+                future = self._inflight.get((cache, key))
+                if cell is not None:
+                    if not cell.valid():
+                        self.stale_served[cache] += 1
+                        if future is None:
+                            self._inflight[cache, key] = Future()
+                            self._urgencies[cache, key] = Urgency(Priority.PREFETCH)
+                            self._refresher.submit(
+                                self._refresh,
+                                cache,
+                                key,
+                                partial(_download_one, download, index),
+                                lifetimes[index],
+                            )
+                    results[index] = cell.data
+                elif future is not None:
+                    self.coalesced[cache] += 1
+                    waiting.append((index, future, self._urgencies[cache, key]))
+                else:
+                    self._inflight[cache, key] = Future()
+                    self._urgencies[cache, key] = urgency
+                    leading.append(index)
+        self._delete_discarded()
+        return (leading, waiting)
+
+    def _record_reads(self, cache: str, keys: List[str]) -> None:
+        """Record versions of cells read in current context, see tracking"""
+        reads = _reads.get()
+        if reads is not None:
+            with self._lock:
+                for key in keys:
+                    cell = self._caches[cache].get(key)
+                    reads[cache, key] = None if cell is None else cell.version
+
+    def _download(
+        self,
+        cache: str,
+        keys: List[str],
+        download: Callable[[], List[Any]],
+        lifetimes: List[Lifetime],
+    ) -> List[Any]:
+        """Download and store entries, passing results to callers waiting on them
+
+        Callers waiting on entries which failed get their exceptions, the first
+        of them is raised. Requests are made with Urgency registered with the
+        entries, so waiting callers can raise their priority.
+        """
+        with self._lock:
+            futures = [self._inflight[cache, key] for key in keys]
+            urgency = self._urgencies[cache, keys[0]]
+        try:
+            with priority(urgency):
+                downloaded, validators = self._fetch(cache, keys, download)
+                if downloaded is not None:
+                    self._replace(cache, keys, downloaded, lifetimes, validators)
+                else:
+                    downloaded = self._extend(cache, keys[0], lifetimes[0])
+                if downloaded is None:
+                    # entry was removed while being revalidated
+                    downloaded = download()
+                    self._replace(cache, keys, downloaded, lifetimes, None)
+        except BaseException as error:
+            for future in futures:
+                future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._inflight.pop((cache, key), None)
+                    self._urgencies.pop((cache, key), None)
+        failures = []
+        for future, data in zip(futures, downloaded):
+            if isinstance(data, Exception):
+                future.set_exception(data)
+                failures.append(data)
+            else:
+                future.set_result(data)
+        if failures:
+            log.warning(
+                "Downloading %d of %d %s entries failed",
+                len(failures),
+                len(keys),
+                cache,
+            )
+            raise failures[0]
+        return downloaded
+
+    def _replace(
+        self,
+        cache: str,
+        keys: List[str],
+        downloaded: List[Any],
+        lifetimes: List[Lifetime],
+        validators: Optional[dict],
+    ) -> None:
+        """Store downloaded entries, with validators of single revalidated entry
+
+        Validators are kept only as long as their entry, entries which never
+        expire are never revalidated. Failed downloads are skipped.
+        """
+        stored = [
+            index
+            for index, data in enumerate(downloaded)
+            if not isinstance(data, Exception)
+        ]
+        if not stored:
+            return
+        keys = [keys[index] for index in stored]
+        downloaded = [downloaded[index] for index in stored]
+        lifetimes = [
+            lifetime(data) if callable(lifetime) else lifetime
+            for data, lifetime in zip(downloaded, [lifetimes[i] for i in stored])
+        ]
+        with self._lock:
+            for key, data, lifetime in zip(keys, downloaded, lifetimes):
+                self._store(cache, key, data, lifetime)
+        self._persist(cache, keys)
+        if cache not in self.revalidated:
+            return
+        name = f"{cache}/{keys[0]}"
+        if validators is None or lifetimes[0] is None:
+            with self._lock:
+                if name in self._caches["validators"]:
+                    self._discard("validators", name)
+            self._delete_discarded()
+            return
+        with self._lock:
+            self._store("validators", name, validators, lifetimes[0])
+        self._persist("validators", [name])
+
+    def _fetch(
+        self, cache: str, keys: List[str], download: Callable[[], List[Any]]
+    ) -> Tuple[Optional[List[Any]], Optional[dict]]:
+        """Call download, conditionally if single entry of cache is being replaced
+
+        Returns data and validators to store, None if the request wasn't
+        conditional. Data is None if upstream didn't change since replaced
+        entry was downloaded.
+        """
+        if len(keys) > 1 or cache not in self.revalidated:
+            return (download(), None)
+        key = keys[0]
+        with self._lock:
+            previous = self._caches[cache].get(key)
+        stored = previous and self._lookup("validators", f"{cache}/{key}")
+        with self._lock:
+            validators = dict(stored.data) if stored else {}
+        try:
+            with revalidation(validators) as recorded:
+                return (download(), recorded or None)
+        except NotModified:
+            log.info("%s %s not modified upstream", cache, key)
+            self.not_modified[cache] += 1
+            return (None, None)
+
+    def _extend(self, cache: str, key: str, lifetime: Lifetime) -> Optional[List[Any]]:
+        """Restart lifetime of entry and its validators, return its data
+
+        Backend only updates timestamps, data isn't written again. Returns None
+        if entry isn't cached anymore.
+        """
+        touched = []
+        cell = self._lookup(cache, key)
+        with self._lock:
+            if cell is None or self._caches[cache].get(key) is not cell:
+                return None
+            data = cell.data
+            if callable(lifetime):
+                lifetime = lifetime(data)
+            now = datetime.now()
+            for name, entry in ((cache, key), ("validators", f"{cache}/{key}")):
+                extended = self._caches[name].get(entry)
+                if extended is None:
+                    continue
+                extended.timestamp = now
+                extended.lifetime = lifetime
+                self._schedule(name, entry)
+                # dirty entries are written with new timestamp anyway
+                if (name, entry) in self._dirty:
+                    continue
+                if self.write_delay is None:
+                    touched.append((name, entry))
+                else:
+                    self._touched[name, entry] = (now, lifetime)
+                    self._wake_writer()
+        for name, entry in touched:
+            self.backend.touch(name, entry, now, lifetime)
+        return [data]
+
+    def _refresh(
+        self,
+        cache: str,
+        key: str,
+        download: Callable[[], Any],
+        lifetime: Lifetime,
+    ) -> None:
+        log.info("Refreshing stale %s %s", cache, key)
+        try:
+            self._download(cache, [key], lambda: [download()], [lifetime])
+        except Exception:  # pylint: disable=broad-exception-caught
+            log.exception("Refreshing %s %s failed", cache, key)
+
+    @contextmanager
+    def tracking(self) -> Iterator[Reads]:
+        """Record versions of cells read within the block, see current"""
+        reads: Reads = {}
+        token = _reads.set(reads)
+        try:
+            yield reads
+        finally:
+            _reads.reset(token)
+
+    def current(self, reads: Reads) -> bool:
+        """Checks if recorded cells are still valid and weren't replaced since"""
+        with self._lock:
+            for (cache, key), version in reads.items():
+                cell = self._caches[cache].get(key)
+                if cell is None or cell.version != version or not cell.valid():
+                    return False
+            return True
+
+    @property
+    def refreshing(self) -> int:
+        """Number of stale entries being refreshed in background"""
+        with self._lock:
+            return sum(1 for cache, key in self._inflight if key in self._caches[cache])
@@ -1,9 +1,11 @@
 """Common utils module"""
 from datetime import date, datetime, timedelta
-from typing import Tuple
+from itertools import cycle
+from typing import Callable, Dict, List, Optional, Tuple
 
 import polars as pl
 from dash.dash_table import DataTable
+from plotly.basedatatypes import BaseTraceType
 from plotly.colors import qualitative as palettes
 
 
@@ -37,12 +39,47 @@ beginning_date = date(2019, 1, 1)
 
 def df_to_dt(data: pl.DataFrame) -> DataTable:
     """Convert polars DataFrame to dash DataTable"""
-    data = data.to_pandas()
-    records = data.to_dict("records")
+    records = data.to_dicts()
     columns = [{"name": i, "id": i} for i in data.columns]
     return DataTable(records, columns)
 
 
+def traces_by(
+    data: pl.DataFrame,
+    group: str,
+    trace: Callable[..., BaseTraceType],
+    columns: Dict[str, str],
+    colors: Optional[Dict[str, str]] = None,
+    color_property: str = "marker_color",
+    **properties,
+) -> List[BaseTraceType]:
+    """Build one trace per value of column group, like color argument of plotly express
+
+    columns maps trace properties to columns passed to plotly as NumPy arrays,
+    properties are passed as they are. Values missing from colors take
+    colors of default palette in order of appearance.
+    """
+    palette = cycle(palettes.Plotly)
+    title = "<b>%{hovertext}</b><br><br>" if "hovertext" in columns else ""
+    axes = f"<br>{columns['x']}=%{{x}}<br>{columns['y']}=%{{y}}<extra></extra>"
+    traces = []
+    for part in data.partition_by(group, maintain_order=True):
+        value = str(part[group][0])
+        color = (colors or {}).get(value) or next(palette)
+        arguments = {
+            "name": value,
+            "legendgroup": value,
+            "hovertemplate": f"{title}{group}={value}{axes}",
+            color_property: color,
+        }
+        arguments.update(
+            {prop: part[column].to_numpy() for prop, column in columns.items()}
+        )
+        arguments.update(properties)
+        traces.append(trace(**arguments))
+    return traces
+
+
 color_map = {
     "basic": palettes.Plotly[7],
     "common": palettes.Plotly[3],
@@ -0,0 +1,118 @@
+"""Summing of 17lands ratings downloaded day by day"""
+from datetime import date, timedelta
+from typing import List, Optional
+
+import polars as pl
+
+
+def day_color_ratings(data: pl.DataFrame, day: date) -> Optional[pl.DataFrame]:
+    """Return color ratings of single day with date column, None if day is empty"""
+    if "games" not in data.columns or data["games"].null_count() == data.height:
+        return None
+    return data.with_columns(
+        pl.col("wins").cast(pl.UInt32),
+        pl.col("games").cast(pl.UInt32),
+        pl.lit(day).alias("date"),
+    )
+
+
+def sum_color_ratings(
+    daily: pl.DataFrame, window_ends: List[date], period: timedelta
+) -> pl.DataFrame:
+    """Sum daily color ratings over windows of period days ending at window_ends
+
+    Result has a row for each color in each window, labeled by step column.
+    """
+    windows = pl.DataFrame({"step": window_ends}).with_columns(
+        pl.col("step").cast(pl.Date)
+    )
+    return (
+        windows.join(daily, how="cross")
+        .filter(
+            (pl.col("date") <= pl.col("step"))
+            & (pl.col("date") > pl.col("step") - period)
+        )
+        .groupby(["step", "color_name"], maintain_order=True)
+        .agg(
+            pl.col("wins").sum(),
+            pl.col("games").sum(),
+            pl.exclude(["step", "color_name", "wins", "games", "date"]).first(),
+        )
+    )
+
+
+def decompose_card_ratings(data: pl.DataFrame) -> pl.DataFrame:
+    """Replace averaged card ratings columns with additive sums
+
+    Every X_win_rate becomes X_wins out of X_game_count games and every avg_X
+    becomes X_sum over X_count cards. Derived rates are dropped.
+    """
+    counts = [column for column in data.columns if column.endswith("_count")]
+    sums = []
+    for column in data.columns:
+        if column.endswith("win_rate") and f"{column[:-8]}game_count" in counts:
+            sums.append(
+                (pl.col(column).cast(pl.Float64) * pl.col(f"{column[:-8]}game_count"))
+                .round(0)
+                .fill_null(0)
+                .cast(pl.UInt32)
+                .alias(f"{column[:-8]}wins")
+            )
+        elif column.startswith("avg_") and f"{column[4:]}_count" in counts:
+            sums.append(
+                (pl.col(column).cast(pl.Float64) * pl.col(f"{column[4:]}_count"))
+                .fill_null(0)
+                .alias(f"{column[4:]}_sum")
+            )
+    return data.with_columns(pl.col(counts).fill_null(0), *sums).select(
+        pl.exclude(
+            [
+                column
+                for column in data.columns
+                if column.endswith("win_rate")
+                or column.startswith("avg_")
+                or column == "play_rate"
+            ]
+        )
+    )
+
+
+def _ratio(numerator: str, denominator: str) -> pl.Expr:
+    return (
+        pl.when(pl.col(denominator) > 0)
+        .then(pl.col(numerator) / pl.col(denominator))
+        .otherwise(None)
+    )
+
+
+def compose_card_ratings(stats: pl.DataFrame) -> pl.DataFrame:
+    """Sum decomposed card ratings per card and derive rates and averages again"""
+    counts = [column for column in stats.columns if column.endswith("_count")]
+    sums = [
+        column
+        for column in stats.columns
+        if column.endswith("wins") or column.endswith("_sum")
+    ]
+    data = stats.groupby("name", maintain_order=True).agg(
+        pl.col(counts + sums).sum(),
+        pl.exclude(["name", "date"] + counts + sums).first(),
+    )
+    rates = [
+        _ratio(column, f"{column[:-4]}game_count").alias(f"{column[:-4]}win_rate")
+        for column in sums
+        if column.endswith("wins")
+    ] + [
+        _ratio(column, f"{column[:-4]}_count").alias(f"avg_{column[:-4]}")
+        for column in sums
+        if column.endswith("_sum")
+    ]
+    if {"game_count", "pool_count"} <= set(counts):
+        rates.append(_ratio("game_count", "pool_count").alias("play_rate"))
+    data = data.with_columns(rates).drop(sums)
+    if {"ever_drawn_win_rate", "never_drawn_win_rate"} <= set(data.columns):
+        data = data.with_columns(
+            (pl.col("ever_drawn_win_rate") - pl.col("never_drawn_win_rate")).alias(
+                "drawn_improvement_win_rate"
+            )
+        )
+    return data
@@ -0,0 +1,95 @@
+"""Local stand-in for 17lands replaying recorded responses"""
+import hashlib
+import logging
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+from ragavan.seventeen_lands import recording_path
+
+log = logging.getLogger("fake_server")
+
+DEFAULT_PORT = 8051
+ENDPOINTS = (
+    "/data/filters",
+    "/color_ratings/data",
+    "/card_ratings/data",
+    "/card_evaluation_metagame/data",
+    "/data/play_draw",
+)
+
+
+class FakeServer(ThreadingHTTPServer):
+    """HTTP server answering 17lands endpoints from recordings directory
+
+    Every response is delayed by latency plus random jitter, error_rate of
+    requests fail with error_status. Responses carry ETag and honour
+    If-None-Match.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        recordings: Path,
+        port: int = DEFAULT_PORT,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+    ):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeServer
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Replay recorded response"""
+        url = urlsplit(self.path)
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        if url.path not in ENDPOINTS:
+            self.send_error(404)
+            return
+        if random.random() < self.server.error_rate:
+            self.send_error(self.server.error_status)
+            return
+        path = recording_path(
+            self.server.recordings, url.path, dict(parse_qsl(url.query))
+        )
+        if not path.exists():
+            self.send_error(404, f"No recording {path.name}")
+            return
+        content = path.read_bytes()
+        etag = f'"{hashlib.sha1(content).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.info(format, *args)
+
+
+def serve(recordings: Path, port: int = DEFAULT_PORT, **faults) -> None:
+    """Serve recordings until interrupted, faults are passed to FakeServer"""
+    with FakeServer(recordings, port, **faults) as server:
+        log.info("Replaying %s on http://127.0.0.1:%d", recordings, port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,72 @@
+"""Memoization of graph callbacks"""
+import os
+import threading
+from collections import Counter, OrderedDict
+from functools import wraps
+from logging import getLogger
+from typing import Any, Callable, Dict, Tuple
+
+import orjson
+
+from ragavan.cache import Cache, Reads
+from ragavan.storage import storage
+
+log = getLogger("figure_cache")
+
+DEFAULT_MAX_ENTRIES = 64
+
+
+class FigureCache:
+    """Bounded cache of callback outputs keyed on callback and its inputs
+
+    Outputs stay valid while storage entries read to build them aren't
+    replaced or expired, least recently used outputs are dropped beyond
+    max_entries.
+    """
+
+    def __init__(self, storage_: Cache, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.storage = storage_
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Tuple[str, bytes], Tuple[Any, Reads]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: Counter[str] = Counter()
+        self.misses: Counter[str] = Counter()
+
+    def memoize(self, callback: Callable[..., Any]) -> Callable[..., Any]:
+        """Decorate callback to return cached output for same inputs"""
+        name = f"{callback.__module__}.{callback.__qualname__}"
+
+        @wraps(callback)
+        def memoized(*args):
+            key = (name, orjson.dumps(args))
+            with self._lock:
+                cached = self._entries.get(key)
+                if cached is not None:
+                    self._entries.move_to_end(key)
+            if cached is not None and self.storage.current(cached[1]):
+                self.hits[name] += 1
+                return cached[0]
+            self.misses[name] += 1
+            with self.storage.tracking() as reads:
+                output = callback(*args)
+            with self._lock:
+                self._entries[key] = (output, reads)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return output
+
+        return memoized
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Return hits and misses of each memoized callback"""
+        return {
+            name: {"hits": self.hits[name], "misses": self.misses[name]}
+            for name in self.hits | self.misses
+        }
+
+
+figure_cache = FigureCache(
+    storage,
+    int(os.environ.get("RAGAVAN_FIGURE_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+)
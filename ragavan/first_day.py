@@ -1,13 +1,16 @@
 """Module with hard-coded first days of formats"""
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple
 
-from ragavan.common import default_event_types, default_expansions
+from ragavan.seventeen_lands import Priority, priority
 from ragavan.storage import storage
 
 log = logging.getLogger("first_day")
 
+DISCOVERY_WORKERS = 4
+
 
 _first_days = {
     ("MOM", "PremierDraft"): date(2023, 4, 13),
@@ -197,38 +200,50 @@ _first_days = {
 }
 
 
-def _all_first_days() -> Dict[Tuple[str, str], date]:
-    filters = storage.get_filters()
-    first_days = {}
-    for expansion in filters["expansions"]:
-        for event_type in filters["formats"]:
-            first_days[expansion, event_type] = storage.get_first_day(
-                expansion, event_type
-            )
-    return first_days
+def _discover(expansion: str, event_type: str) -> Optional[date]:
+    with priority(Priority.DISCOVERY):
+        return storage.get_first_day(expansion, event_type)
 
 
-def _selected_first_days() -> Dict[Tuple[str, str], date]:
-    first_days = {}
-    for expansion in default_expansions:
-        for event_type in default_event_types:
-            first_days[expansion, event_type] = storage.get_first_day(
-                expansion, event_type
-            )
-    return first_days
-
+def discover_first_days(
+    workers: int = DISCOVERY_WORKERS,
+) -> Dict[Tuple[str, str], Optional[date]]:
+    """Find first days of all formats not known yet, several at once
 
-def _update_first_days(
-    first_days: Dict[Tuple[str, str], date]
-) -> Dict[Tuple[str, str], date]:
+    Formats come from 17lands filters. Found first days are persisted in first
+    day table consulted by get_first_day. Returns result for each searched
+    format, None if it has no games yet.
+    """
     filters = storage.get_filters()
-    first_days = dict(_first_days)
-    for expansion in filters["expansions"]:
-        for event_type in filters["formats"]:
-            if (expansion, event_type) not in first_days:
-                first_days[expansion, event_type] = storage.get_first_day(
-                    expansion, event_type
-                )
+    known = set(_first_days) | set(
+        storage.get_first_day_table().select("expansion", "event_type").rows()
+    )
+    formats_by_expansion = filters.get("formats_by_expansion", {})
+    missing = [
+        (expansion, event_type)
+        for expansion in filters["expansions"]
+        for event_type in formats_by_expansion.get(expansion, filters["formats"])
+        if (expansion, event_type) not in known
+    ]
+    log.info("Discovering first days of %d formats", len(missing))
+    first_days = {}
+    with ThreadPoolExecutor(workers, thread_name_prefix="discovery") as executor:
+        futures = {executor.submit(_discover, *pair): pair for pair in missing}
+        for done, future in enumerate(as_completed(futures), 1):
+            expansion, event_type = futures[future]
+            try:
+                first_days[expansion, event_type] = future.result()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("Discovering %s %s failed", expansion, event_type)
+                continue
+            log.info(
+                "[%d/%d] %s %s: %s",
+                done,
+                len(missing),
+                expansion,
+                event_type,
+                first_days[expansion, event_type],
+            )
     return first_days
 
 
@@ -243,7 +258,12 @@ def _generate_first_days(first_days: Dict[Tuple[str, str], date]) -> str:
 
 
 def _print_generated():
-    print(_generate_first_days(_update_first_days(_first_days)))
+    discover_first_days()
+    table = storage.get_first_day_table()
+    first_days = dict(_first_days)
+    for expansion, event_type, first_day in table.rows():
+        first_days.setdefault((expansion, event_type), first_day)
+    print(_generate_first_days(first_days))
 
 
 def get_first_day(
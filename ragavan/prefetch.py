@@ -0,0 +1,87 @@
+"""Warming up cache with data shown by default views"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import product
+from typing import Any, Callable, Dict, List, Tuple
+
+from ragavan.common import default_event_types, default_expansions, optimal_date_range
+from ragavan.first_day import get_first_day
+from ragavan.seventeen_lands import Priority, priority, scheduler
+from ragavan.storage import storage
+
+log = logging.getLogger("prefetch")
+
+DEFAULT_WORKERS = 4
+
+
+def _tasks() -> List[Tuple[str, Callable[[], Any]]]:
+    tasks = [
+        ("filters", storage.get_filters),
+        ("play/draw", storage.get_play_draw),
+    ]
+    for expansion, event_type in product(default_expansions, default_event_types):
+        first_day = get_first_day(expansion, event_type)
+        if first_day is None:
+            continue
+        start_date, end_date = optimal_date_range(first_day)
+        tasks.append(
+            (
+                f"color ratings {expansion} {event_type}",
+                partial(
+                    storage.get_summed_color_ratings,
+                    expansion,
+                    event_type,
+                    start_date,
+                    end_date,
+                    True,
+                ),
+            )
+        )
+        tasks.append(
+            (
+                f"card ratings {expansion} {event_type}",
+                partial(
+                    storage.get_summed_card_ratings,
+                    expansion,
+                    event_type,
+                    start_date,
+                    end_date,
+                ),
+            )
+        )
+    return tasks
+
+
+def _timed(task: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    with priority(Priority.PREFETCH):
+        task()
+    return time.perf_counter() - start
+
+
+def prefetch(workers: int = DEFAULT_WORKERS) -> Dict[str, float]:
+    """Fetch data for default views into cache, return seconds each task took"""
+    start = time.perf_counter()
+    tasks = _tasks()
+    timings = {}
+    log.info("Prefetching %d datasets with %d workers", len(tasks), workers)
+    with ThreadPoolExecutor(workers, thread_name_prefix="prefetch") as executor:
+        futures = {executor.submit(_timed, task): name for name, task in tasks}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                timings[name] = future.result()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("[%d/%d] %s failed", done, len(tasks), name)
+                continue
+            log.info("[%d/%d] %s in %.2fs", done, len(tasks), name, timings[name])
+    log.info(
+        "Prefetched %d/%d datasets in %.2fs",
+        len(timings),
+        len(tasks),
+        time.perf_counter() - start,
+    )
+    log.info("Request scheduler stats: %s", scheduler.stats())
+    return timings
@@ -1,16 +1,107 @@
 """Ragavan - MTG limited analysis"""
+import signal
+import sys
+from argparse import ArgumentParser
 from logging import INFO, basicConfig, getLogger
 from os import environ
+from pathlib import Path
+from threading import Thread
 
 from ragavan.app import app
+from ragavan.fake_server import DEFAULT_PORT, serve
+from ragavan.first_day import DISCOVERY_WORKERS, discover_first_days
+from ragavan.prefetch import DEFAULT_WORKERS, prefetch
+from ragavan.storage import storage
+from ragavan.ui import card_ratings, color_ratings, play_draw
 from ragavan.ui.layout import layout
 
 
+def _warm_up():
+    prefetch()
+    for view in (play_draw, color_ratings, card_ratings):
+        try:
+            view.warm_up()
+        except Exception:  # pylint: disable=broad-exception-caught
+            getLogger("ragavan").exception("Warming up %s failed", view.__name__)
+    discover_first_days()
+
+
+def _terminate(signum, _frame):
+    """Exit normally, so that cached data waiting for background writer is flushed"""
+    sys.exit(128 + signum)
+
+
 def main():
     """Main entrypoint of the program"""
-    debug = bool(environ.get("RAGAVAN_DEBUG"))
+    parser = ArgumentParser(prog="ragavan", description="MTG limited analysis")
+    commands = parser.add_subparsers(dest="command")
+    prefetch_parser = commands.add_parser(
+        "prefetch", help="download data shown by default views into cache"
+    )
+    prefetch_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of concurrent downloads",
+    )
+    discover_parser = commands.add_parser(
+        "discover", help="find first days of all formats not known yet"
+    )
+    discover_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=DISCOVERY_WORKERS,
+        help="number of formats searched at once",
+    )
+    fake_server_parser = commands.add_parser(
+        "fake-server", help="serve recorded 17lands responses locally"
+    )
+    fake_server_parser.add_argument(
+        "recordings", type=Path, help="directory with recorded responses"
+    )
+    fake_server_parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT)
+    fake_server_parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every response"
+    )
+    fake_server_parser.add_argument(
+        "--jitter", type=float, default=0.0, help="maximum random extra latency"
+    )
+    fake_server_parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="fraction of failed requests"
+    )
+    fake_server_parser.add_argument(
+        "--error-status", type=int, default=503, help="status of failed requests"
+    )
+    args = parser.parse_args()
+
     basicConfig(level=INFO)
     log = getLogger("ragavan")
+    # docker stop and process managers send SIGTERM, which skips atexit handlers
+    signal.signal(signal.SIGTERM, _terminate)
+    if args.command == "prefetch":
+        prefetch(args.workers)
+        storage.flush()
+        return
+    if args.command == "discover":
+        discover_first_days(args.workers)
+        storage.flush()
+        return
+    if args.command == "fake-server":
+        serve(
+            args.recordings,
+            args.port,
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+        )
+        return
+
+    debug = bool(environ.get("RAGAVAN_DEBUG"))
     log.info("Ragavan starting")
+    if environ.get("RAGAVAN_WARMUP"):
+        Thread(target=_warm_up, name="warmup", daemon=True).start()
     app.layout = layout()
     app.run(host="0.0.0.0", port=8050, debug=debug)
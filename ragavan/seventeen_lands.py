@@ -1,26 +1,449 @@
 """17lands data fetching"""
+import hashlib
+import heapq
 import logging
-from datetime import date
-from typing import Optional
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from enum import IntEnum
+from itertools import chain, count
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
+import orjson
 import polars as pl
 import requests
+from requests.adapters import HTTPAdapter
 
-from ragavan.common import format_date
+from ragavan.common import beginning_date, format_date
 
 log = logging.getLogger("17lands")
-URL_BASE = "https://www.17lands.com"
+URL_BASE = os.environ.get("RAGAVAN_17LANDS_URL", "https://www.17lands.com").rstrip("/")
 URL_FILTERS = f"{URL_BASE}/data/filters"
 URL_COLOR_RATINGS = f"{URL_BASE}/color_ratings/data"
 URL_CARD_RATINGS = f"{URL_BASE}/card_ratings/data"
 URL_CARD_EVALUATION_METAGAME = f"{URL_BASE}/card_evaluation_metagame/data"
 URL_PLAY_DRAW = f"{URL_BASE}/data/play_draw"
 
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 10
+BATCH_WORKERS = 6
+DEFAULT_RATE_LIMIT = 4.0
+DEFAULT_BURST = 8
+INTERACTIVE_RESERVE = 2
+SLOW_ADMISSION = 1.0
+FIRST_DAY_BRANCHING = 3
 
-def _fetch(url: str, params: dict = None) -> dict:
+Schema = Dict[str, Any]
+
+COLOR_RATINGS_SCHEMA: Schema = {
+    "is_summary": pl.Boolean,
+    "color_name": pl.Categorical,
+    "short_name": pl.Categorical,
+    "wins": pl.UInt32,
+    "games": pl.UInt32,
+}
+CARD_RATINGS_SCHEMA: Schema = {
+    "name": pl.Categorical,
+    "mtga_id": pl.UInt32,
+    "color": pl.Categorical,
+    "rarity": pl.Categorical,
+    "url": pl.Utf8,
+    "url_back": pl.Utf8,
+    "types": pl.List(pl.Utf8),
+    "seen_count": pl.UInt32,
+    "avg_seen": pl.Float32,
+    "pick_count": pl.UInt32,
+    "avg_pick": pl.Float32,
+    "game_count": pl.UInt32,
+    "pool_count": pl.UInt32,
+    "play_rate": pl.Float32,
+    "win_rate": pl.Float32,
+    "opening_hand_game_count": pl.UInt32,
+    "opening_hand_win_rate": pl.Float32,
+    "drawn_game_count": pl.UInt32,
+    "drawn_win_rate": pl.Float32,
+    "ever_drawn_game_count": pl.UInt32,
+    "ever_drawn_win_rate": pl.Float32,
+    "never_drawn_game_count": pl.UInt32,
+    "never_drawn_win_rate": pl.Float32,
+    "drawn_improvement_win_rate": pl.Float32,
+}
+CARD_EVALUATION_SCHEMA: Schema = {
+    "pick_n": pl.UInt32,
+    "pick_avg": pl.Float32,
+    "seen_n": pl.UInt32,
+    "seen_avg": pl.Float32,
+}
+PLAY_DRAW_SCHEMA: Schema = {
+    "expansion": pl.Categorical,
+    "event_type": pl.Categorical,
+}
+
+# categorical columns of separately downloaded frames are concatenated and
+# joined, which needs them to share one string cache
+pl.toggle_string_cache(True)
+
+
+def _create_session(pool_size: int) -> requests.Session:
+    """Create session keeping up to pool_size connections to every host alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session = _create_session(
+    int(os.environ.get("RAGAVAN_HTTP_POOL_SIZE", DEFAULT_POOL_SIZE))
+)
+
+
+class Priority(IntEnum):
+    """Priority classes of requests to 17lands, lower values are served first"""
+
+    INTERACTIVE = 0
+    PREFETCH = 1
+    DISCOVERY = 2
+
+
+class Urgency:
+    """Priority class of requests of one download, raised by callers waiting for it
+
+    Requests of the download already queued by scheduler are moved up when it's
+    raised, so more urgent caller doesn't wait at background priority.
+    """
+
+    def __init__(self, level: Priority) -> None:
+        self.level = level
+
+    def raise_to(self, level: Priority) -> None:
+        """Serve requests at least with priority class level from now on"""
+        if level < self.level:
+            self.level = level
+            scheduler.reprioritize()
+
+
+def _level(level: Union[Priority, Urgency]) -> Priority:
+    return level.level if isinstance(level, Urgency) else level
+
+
+_priority: ContextVar[Union[Priority, Urgency]] = ContextVar(
+    "priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def priority(level: Union[Priority, Urgency]) -> Iterator[None]:
+    """Make requests made within the block use given priority class"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> Priority:
+    """Return priority class of requests made in current context"""
+    return _level(_priority.get())
+
+
+class RequestScheduler:
+    """Priority-aware token bucket rate limit shared by all requests to 17lands"""
+
+    def __init__(
+        self,
+        rate: Optional[float] = DEFAULT_RATE_LIMIT,
+        burst: int = DEFAULT_BURST,
+        reserve: int = INTERACTIVE_RESERVE,
+    ):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.reserve = min(reserve, self.burst - 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        # tickets of waiting requests: priority class, arrival and its source
+        self._queue: List[List[Any]] = []
+        self._arrivals = count()
+        self._condition = threading.Condition()
+        self.admitted: Counter = Counter()
+        self.waited: Counter = Counter()
+        self.max_wait: Dict[Priority, float] = {}
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, level: Union[Priority, Urgency]) -> float:
+        """Block until request of given priority may be sent, return seconds waited"""
+        if self.rate is None:
+            return 0.0
+        start = time.monotonic()
+        with self._condition:
+            ticket = [_level(level), next(self._arrivals), level]
+            heapq.heappush(self._queue, ticket)
+            while True:
+                self._refill()
+                needed = 1 if ticket[0] == Priority.INTERACTIVE else 1 + self.reserve
+                if self._queue[0] is ticket:
+                    if self._tokens >= needed:
+                        break
+                    self._condition.wait((needed - self._tokens) / self.rate)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._queue)
+            level = ticket[0]
+            self._tokens -= 1
+            depth = len(self._queue)
+            waited = time.monotonic() - start
+            self.admitted[level] += 1
+            self.waited[level] += waited
+            self.max_wait[level] = max(self.max_wait.get(level, 0.0), waited)
+            self._condition.notify_all()
+        if waited > SLOW_ADMISSION:
+            log.info(
+                "%s request waited %.1fs for rate limit, %d more queued",
+                level.name.lower(),
+                waited,
+                depth,
+            )
+        return waited
+
+    def reprioritize(self) -> None:
+        """Move waiting requests up the queue after their Urgency was raised"""
+        with self._condition:
+            for ticket in self._queue:
+                ticket[0] = _level(ticket[2])
+            heapq.heapify(self._queue)
+            self._condition.notify_all()
+
+    @property
+    def queued(self) -> Counter:
+        """Number of requests waiting in each priority class"""
+        with self._condition:
+            return Counter(level for level, *_ in self._queue)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return queue depth, admitted requests and wait times of priority classes"""
+        queued = self.queued
+        with self._condition:
+            return {
+                level.name.lower(): {
+                    "queued": queued[level],
+                    "admitted": self.admitted[level],
+                    "mean_wait": self.waited[level] / self.admitted[level]
+                    if self.admitted[level]
+                    else 0.0,
+                    "max_wait": self.max_wait.get(level, 0.0),
+                }
+                for level in Priority
+            }
+
+
+scheduler = RequestScheduler(
+    float(os.environ.get("RAGAVAN_RATE_LIMIT", DEFAULT_RATE_LIMIT)) or None,
+    int(os.environ.get("RAGAVAN_RATE_BURST", DEFAULT_BURST)),
+)
+
+
+class NotModified(Exception):
+    """Raised when fetched data didn't change since validators were recorded"""
+
+
+# validators sent with the next request and dict receiving those of its response
+_validators: ContextVar[Optional[Tuple[dict, dict]]] = ContextVar(
+    "validators", default=None
+)
+
+
+@contextmanager
+def revalidation(validators: dict) -> Iterator[dict]:
+    """Make first request within the block conditional on validators
+
+    The request raises NotModified if server answers 304 or content hash is
+    the same as before. Otherwise ETag, Last-Modified and content hash of the
+    response are recorded in yielded dict, which stays empty if no request was
+    made in the block.
+    """
+    recorded: dict = {}
+    token = _validators.set((validators, recorded))
+    try:
+        yield recorded
+    finally:
+        _validators.reset(token)
+
+
+def _conditional_headers(validators: dict) -> dict:
+    headers = {}
+    if "etag" in validators:
+        headers["If-None-Match"] = validators["etag"]
+    if "last_modified" in validators:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def _revalidate(validators: dict, recorded: dict, resp: requests.Response) -> None:
+    """Raise NotModified if response didn't change, record its validators otherwise"""
+    if resp.status_code == 304:
+        raise NotModified()
+    resp.raise_for_status()
+    content_hash = hashlib.sha1(resp.content).hexdigest()
+    if content_hash == validators.get("hash"):
+        raise NotModified()
+    recorded["hash"] = content_hash
+    if "ETag" in resp.headers:
+        recorded["etag"] = resp.headers["ETag"]
+    if "Last-Modified" in resp.headers:
+        recorded["last_modified"] = resp.headers["Last-Modified"]
+
+
+def _get(url: str, params: Optional[dict], headers: dict) -> requests.Response:
+    scheduler.acquire(_priority.get())
+    return _session.get(url, params=params, headers=headers, timeout=(5, 30))
+
+
+def _retry_delay(attempt: int, resp: Optional[requests.Response]) -> float:
+    """Exponential backoff with jitter, unless server asks for specific delay"""
+    retry_after = resp.headers.get("Retry-After", "") if resp is not None else ""
+    if retry_after.isdigit():
+        return float(retry_after)
+    return BACKOFF * 2**attempt * random.uniform(0.5, 1.5)
+
+
+def _fetch_bytes(url: str, params: dict = None) -> bytes:
+    """Fetch raw response body from url, retrying on connection errors, 429 and 5xx
+
+    Raises requests.RequestException if data couldn't be fetched, so that
+    nothing invalid gets cached. See revalidation for conditional requests.
+    """
     log.info("fetching %s from %s", params, url)
-    resp = requests.get(url, params=params, timeout=(5, 30))
-    return resp.json()
+    revalidated = _validators.get()
+    # only the first request within revalidation block is conditional
+    _validators.set(None)
+    headers = _conditional_headers(revalidated[0]) if revalidated is not None else {}
+    for attempt in range(MAX_RETRIES):
+        try:
+            resp = _get(url, params, headers)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            resp = None
+            reason = type(error).__name__
+        else:
+            if resp.status_code not in RETRY_STATUSES:
+                break
+            reason = resp.status_code
+        delay = _retry_delay(attempt, resp)
+        log.warning("fetching %s failed (%s), retrying in %.1fs", url, reason, delay)
+        time.sleep(delay)
+    else:
+        resp = _get(url, params, headers)
+    if revalidated is not None:
+        _revalidate(*revalidated, resp)
+    resp.raise_for_status()
+    if _record_dir is not None:
+        _record(url, params, resp.content)
+    return resp.content
+
+
+def recording_path(directory: Path, path: str, params: Optional[dict]) -> Path:
+    """Return file holding recorded response of endpoint path for given parameters"""
+    query = "&".join(
+        f"{name}={value}" for name, value in sorted((params or {}).items())
+    )
+    digest = hashlib.sha1(query.encode()).hexdigest()[:16]
+    return directory / f"{path.strip('/').replace('/', '_')}-{digest}.json"
+
+
+def _record(url: str, params: Optional[dict], content: bytes) -> None:
+    """Save response body into RAGAVAN_RECORD_DIR for replaying by fake server"""
+    path = recording_path(_record_dir, url[len(URL_BASE) :], params)
+    tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+    log.info("recorded %s", path.name)
+
+
+_record_dir = (
+    Path(os.environ["RAGAVAN_RECORD_DIR"])
+    if os.environ.get("RAGAVAN_RECORD_DIR")
+    else None
+)
+if _record_dir is not None:
+    _record_dir.mkdir(parents=True, exist_ok=True)
+
+
+def _fetch(url: str, params: dict = None) -> Any:
+    """Fetch and parse JSON from url, see _fetch_bytes"""
+    return orjson.loads(_fetch_bytes(url, params))
+
+
+def decode_rows(payload: bytes, schema: Schema) -> pl.DataFrame:
+    """Decode JSON list of objects into DataFrame column by column
+
+    Declared columns are built directly with their dtypes, so no schema is
+    inferred row by row, and are null in rows missing them. Fields missing in
+    schema, found in any row, keep inferred dtypes.
+    """
+    rows = orjson.loads(payload)
+    if not rows:
+        return pl.DataFrame(schema=schema)
+    undeclared = dict.fromkeys(
+        name for row in rows for name in row if name not in schema
+    )
+    return pl.DataFrame(
+        [
+            _decode_column(name, [row.get(name) for row in rows], schema.get(name))
+            for name in [*schema, *undeclared]
+        ]
+    )
+
+
+def _decode_column(name: str, values: List[Any], dtype: Any) -> pl.Series:
+    if dtype == pl.Categorical:
+        return pl.Series(name, values, dtype=pl.Utf8).cast(pl.Categorical)
+    return pl.Series(name, values, dtype=dtype)
+
+
+def _download_many(
+    download: Callable[[Tuple[date, date]], pl.DataFrame],
+    date_ranges: List[Tuple[date, date]],
+    workers: int,
+) -> List[Union[pl.DataFrame, Exception]]:
+    """Download data for many date ranges concurrently
+
+    Returns DataFrames in order of date ranges, at most workers requests run at
+    the same time. Ranges which couldn't be downloaded are returned as exceptions
+    they raised, so the others can still be used.
+    """
+    if len(date_ranges) == 1:
+        # in calling thread, so that single request can be revalidated
+        try:
+            return [download(date_ranges[0])]
+        except NotModified:
+            raise
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            return [error]
+    level = _priority.get()
+
+    def prioritized(date_range: Tuple[date, date]) -> Union[pl.DataFrame, Exception]:
+        with priority(level):
+            try:
+                return download(date_range)
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                return error
+
+    with ThreadPoolExecutor(
+        min(workers, len(date_ranges)) or 1, thread_name_prefix="17lands"
+    ) as executor:
+        return list(executor.map(prioritized, date_ranges))
 
 
 def download_filters() -> dict:
@@ -44,11 +467,29 @@ def download_color_ratings(
         "end_date": format_date(end_date),
         "combine_splash": "true" if combine_splash else "false",
     }
-    data = _fetch(URL_COLOR_RATINGS, params=params)
-    data = pl.DataFrame(data)
+    data = decode_rows(
+        _fetch_bytes(URL_COLOR_RATINGS, params=params), COLOR_RATINGS_SCHEMA
+    )
     return data
 
 
+def download_color_ratings_many(
+    expansion: str,
+    event_type: str,
+    date_ranges: List[Tuple[date, date]],
+    combine_splash: bool,
+    workers: int = BATCH_WORKERS,
+) -> List[Union[pl.DataFrame, Exception]]:
+    """Download 17lands color ratings data for many date ranges, see _download_many"""
+    return _download_many(
+        lambda date_range: download_color_ratings(
+            expansion, event_type, *date_range, combine_splash
+        ),
+        date_ranges,
+        workers,
+    )
+
+
 def download_card_ratings(
     expansion: str,
     event_type: str,
@@ -65,11 +506,29 @@ def download_card_ratings(
     }
     if colors:
         params["colors"] = colors
-    data = _fetch(URL_CARD_RATINGS, params=params)
-    data = pl.DataFrame(data)
+    data = decode_rows(
+        _fetch_bytes(URL_CARD_RATINGS, params=params), CARD_RATINGS_SCHEMA
+    )
     return data
 
 
+def download_card_ratings_many(
+    expansion: str,
+    event_type: str,
+    date_ranges: List[Tuple[date, date]],
+    colors: Optional[str] = None,
+    workers: int = BATCH_WORKERS,
+) -> List[Union[pl.DataFrame, Exception]]:
+    """Download 17lands card ratings data for many date ranges, see _download_many"""
+    return _download_many(
+        lambda date_range: download_card_ratings(
+            expansion, event_type, *date_range, colors
+        ),
+        date_ranges,
+        workers,
+    )
+
+
 def download_card_evaluation_metagame(
     expansion: str,
     event_type: str,
@@ -77,8 +536,12 @@ def download_card_evaluation_metagame(
     rarity: str | None,
     start_date: date,
     end_date: date,
-) -> pl.DataFrame:
-    """Download 17lands card evaluation metagame data, convert to polars DataFrame and return it"""
+) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """Download 17lands card evaluation metagame data, return metagame and cards tables
+
+    Metagame table has a row for every card on every date, cards table holds
+    image of every card. Both are keyed by categorical card name.
+    """
     params = {
         "expansion": expansion,
         "format": event_type,
@@ -90,25 +553,93 @@ def download_card_evaluation_metagame(
     if rarity:
         params["rarity"] = rarity
     data = _fetch(URL_CARD_EVALUATION_METAGAME, params=params)
-    data_fixed = []
-    for date_ix in range(len(data["dates"])):
-        for card_ix in range(len(data["cards"])):
-            card = {
-                "name": data["cards"][card_ix],
-                "date": data["dates"][date_ix],
-                "image": data["images"][card_ix],
-                "pick_n": data["data"][date_ix][card_ix]["pick_n"],
-                "pick_avg": data["data"][date_ix][card_ix]["pick_avg"],
-                "seen_n": data["data"][date_ix][card_ix]["seen_n"],
-                "seen_avg": data["data"][date_ix][card_ix]["seen_avg"],
-            }
-            data_fixed.append(card)
-    data = pl.DataFrame(data_fixed).unique()
-    return data
+    cards = pl.DataFrame(
+        [
+            pl.Series("name", data["cards"], dtype=pl.Utf8).cast(pl.Categorical),
+            pl.Series("image", data["images"], dtype=pl.Utf8),
+        ]
+    )
+    # cells are stored date by date, each date holding all cards in order
+    cells = list(chain.from_iterable(data["data"]))
+    cell_index = pl.arange(0, len(cells), eager=True)
+    metagame = pl.DataFrame(
+        [
+            cards["name"].take(cell_index % len(cards)),
+            pl.Series("date", data["dates"], dtype=pl.Utf8).take(
+                cell_index // len(cards)
+            ),
+            *(
+                pl.Series(field, [cell[field] for cell in cells], dtype=dtype)
+                for field, dtype in CARD_EVALUATION_SCHEMA.items()
+            ),
+        ]
+    )
+    return (metagame, cards)
 
 
 def download_play_draw() -> pl.DataFrame:
     """Download 17lands play/draw advantage data, convert to polars DataFrame and return it"""
-    data = _fetch(URL_PLAY_DRAW)
-    data = pl.DataFrame(data)
+    data = decode_rows(_fetch_bytes(URL_PLAY_DRAW), PLAY_DRAW_SCHEMA)
     return data
+
+
+def _segments(start_date: date, end_date: date, parts: int) -> List[Tuple[date, date]]:
+    """Split date range into at most parts consecutive ranges of equal length"""
+    length = -(-((end_date - start_date).days + 1) // parts)
+    segments = []
+    while start_date <= end_date:
+        segment_end = min(start_date + timedelta(days=length - 1), end_date)
+        segments.append((start_date, segment_end))
+        start_date = segment_end + timedelta(days=1)
+    return segments
+
+
+def _has_games(ratings: pl.DataFrame) -> bool:
+    """Checks if color ratings include any games"""
+    if "games" not in ratings.columns:
+        return False
+    return bool(
+        ratings.filter(pl.col("color_name") == "All Decks")["games"].fill_null(0).sum()
+    )
+
+
+def find_first_day(expansion: str, event_type: str) -> Optional[date]:
+    """Find first day with games of format, None if it has no games yet
+
+    Each round downloads color ratings of consecutive segments of remaining
+    date range concurrently and continues within the earliest segment with
+    games. Once range is known to have games its last segment isn't probed.
+    Probes are not cached.
+    """
+    start_date = beginning_date
+    end_date = datetime.now().date()
+    known = False
+    rounds = probe_count = 0
+    while start_date < end_date:
+        rounds += 1
+        segments = _segments(start_date, end_date, FIRST_DAY_BRANCHING)
+        probed = segments[:-1] if known else segments
+        probe_count += len(probed)
+        probes = download_color_ratings_many(
+            expansion, event_type, probed, False, workers=len(probed)
+        )
+        for segment, ratings in zip(probed, probes):
+            if isinstance(ratings, Exception):
+                raise ratings
+            if _has_games(ratings):
+                break
+        else:
+            if not known:
+                log.info("No games of %s %s found", expansion, event_type)
+                return None
+            segment = segments[-1]
+        start_date, end_date = segment
+        known = True
+    log.info(
+        "First day of %s %s found with %d requests in %d rounds",
+        expansion,
+        event_type,
+        probe_count,
+        rounds,
+    )
+    return start_date
@@ -1,91 +1,100 @@
 """Caching system for 17lands data"""
-import pickle
+import os
 from datetime import date, datetime, timedelta
+from functools import partial
 from logging import getLogger
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import polars as pl
-from platformdirs import user_cache_path
 
-from ragavan.common import beginning_date, format_date
+from ragavan.backends import backend_from_url
+from ragavan.cache import (
+    DEFAULT_MAX_STALE,
+    DEFAULT_MEMORY_BUDGET,
+    DEFAULT_WRITE_DELAY,
+    Cache,
+)
+from ragavan.common import format_date
+from ragavan.daily import (
+    compose_card_ratings,
+    day_color_ratings,
+    decompose_card_ratings,
+    sum_color_ratings,
+)
 from ragavan.seventeen_lands import (
+    COLOR_RATINGS_SCHEMA,
     download_card_evaluation_metagame,
     download_card_ratings,
+    download_card_ratings_many,
     download_color_ratings,
+    download_color_ratings_many,
     download_filters,
     download_play_draw,
+    find_first_day,
 )
 
 log = getLogger("storage")
 
+CACHES = (
+    "filters",
+    "play_draw",
+    "color_ratings",
+    "color_ratings_daily",
+    "card_ratings",
+    "card_ratings_daily",
+    "card_evaluation_metagame",
+    "card_evaluation_cards",
+    "first_day",
+    "first_day_table",
+    "validators",
+)
+# caches downloaded by single request per entry, which may be revalidated
+REVALIDATED_CACHES = (
+    "filters",
+    "play_draw",
+    "color_ratings",
+    "card_ratings",
+    "card_evaluation_metagame",
+    "card_evaluation_cards",
+)
+DEFAULT_RECENT_LIFETIME = timedelta(hours=1)
+SETTLE_PERIOD = timedelta(days=3)
+FIRST_DAY_TABLE_SCHEMA = {
+    "expansion": pl.Utf8,
+    "event_type": pl.Utf8,
+    "first_day": pl.Date,
+}
 
-class StorageCell:
-    """Cell holding any data and its time of validity"""
-
-    def __init__(self, data: Any, lifetime: timedelta = timedelta(days=1)) -> None:
-        self.data = data
-        self.timestamp = date.today()
-        self.lifetime = lifetime
 
-    def valid(self) -> date:
-        """Checks if data held by this cell is valid"""
-        return date.today() - self.timestamp > self.lifetime
+class Storage(Cache):
+    """Caching and persisting system for 17lands data"""
 
+    caches = CACHES
+    revalidated = REVALIDATED_CACHES
 
-class Storage:
-    """Caching and persisting system for 17lands data"""
+    def __init__(
+        self,
+        *args: Any,
+        recent_lifetime: timedelta = DEFAULT_RECENT_LIFETIME,
+        daily_ratings: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.recent_lifetime = recent_lifetime
+        self.daily_ratings = daily_ratings
 
-    path = user_cache_path("ragavan", "AcidBishop") / "storage"
-
-    def __init__(self) -> None:
-        self._filters = None
-        self._play_draw = None
-        self._color_ratings = {}
-        self._card_ratings = {}
-        self._card_evaluation_metagame = {}
-        self._first_day = {}
-
-    def save(self) -> None:
-        """Persist cache to disk"""
-        log.info("Persisting storage")
-        self.path.parent.mkdir(exist_ok=True)
-        with open(self.path, "bw") as file:
-            pickle.dump(self, file)
-
-    @classmethod
-    def load(cls) -> "Storage":
-        """Instantiate new Storage object from disk"""
-        log.info("Loading storage")
-        with open(cls.path, "br") as file:
-            return pickle.load(file)
-
-    def purge(self) -> None:
-        """Remove all invalid data from cache"""
-        if self._filters and self._filters.valid():
-            self._filters = None
-        if self._play_draw and self._play_draw.valid():
-            self._play_draw = None
-        for key in list(self._color_ratings.keys()):
-            if self._color_ratings[key].valid():
-                del self._color_ratings[key]
-        for key in list(self._card_ratings.keys()):
-            if self._card_ratings[key].valid():
-                del self._card_ratings[key]
-        for key in list(self._card_evaluation_metagame.keys()):
-            if self._card_evaluation_metagame[key].valid():
-                del self._card_evaluation_metagame[key]
-        for key in list(self._first_day.keys()):
-            if self._first_day[key].valid():
-                del self._first_day[key]
+    def range_lifetime(self, end_date: date) -> Optional[timedelta]:
+        """Return lifetime of data for date range ending at end_date"""
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        if datetime.now().date() - end_date > SETTLE_PERIOD:
+            return None
+        return self.recent_lifetime
 
     def get_filters(self) -> dict:
         """Return filters from cache or download from 17lands if not found"""
-        self.purge()
         log.info("retrieving filters")
-        if not self._filters:
-            self._filters = StorageCell(download_filters())
-            self.save()
-        return self._filters.data
+        return self._get("filters", "filters", download_filters)
 
     def get_color_ratings(
         self,
@@ -96,17 +105,156 @@ class Storage:
         combine_splash: bool = False,
     ) -> pl.DataFrame:
         """Return color ratings data from cache or download from 17lands if not found"""
-        self.purge()
         log.info("retrieving color ratings")
         key = f"{expansion}-{event_type}-{format_date(start_date)}-{format_date(end_date)}-{combine_splash}"
-        if key not in self._color_ratings:
-            self._color_ratings[key] = StorageCell(
-                download_color_ratings(
-                    expansion, event_type, start_date, end_date, combine_splash
-                )
+        return self._get(
+            "color_ratings",
+            key,
+            partial(
+                download_color_ratings,
+                expansion,
+                event_type,
+                start_date,
+                end_date,
+                combine_splash,
+            ),
+            self.range_lifetime(end_date),
+        )
+
+    def get_color_ratings_many(
+        self,
+        expansion: str,
+        event_type: str,
+        date_ranges: List[Tuple[date, date]],
+        combine_splash: bool = False,
+    ) -> List[pl.DataFrame]:
+        """Return color ratings data for many date ranges in their order
+
+        Ranges missing in cache are downloaded from 17lands concurrently and
+        persisted together.
+        """
+        log.info("retrieving color ratings for %d date ranges", len(date_ranges))
+        keys = [
+            f"{expansion}-{event_type}-{format_date(start_date)}-"
+            f"{format_date(end_date)}-{combine_splash}"
+            for start_date, end_date in date_ranges
+        ]
+        return self._get_many(
+            "color_ratings",
+            keys,
+            lambda indexes: download_color_ratings_many(
+                expansion,
+                event_type,
+                [date_ranges[index] for index in indexes],
+                combine_splash,
+            ),
+            [self.range_lifetime(end_date) for _, end_date in date_ranges],
+        )
+
+    def get_daily_color_ratings(
+        self,
+        expansion: str,
+        event_type: str,
+        start_date: date,
+        end_date: date,
+        combine_splash: bool = False,
+    ) -> pl.DataFrame:
+        """Return color ratings of every day from start_date to end_date inclusive
+
+        Each day is cached separately, so only days not stored yet are downloaded.
+        Settled days never expire. Days without games are left out of result.
+        """
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        days = [
+            start_date + timedelta(days=offset)
+            for offset in range((end_date - start_date).days + 1)
+        ]
+        log.info("retrieving daily color ratings for %d days", len(days))
+        ratings = self._get_many(
+            "color_ratings_daily",
+            [
+                f"{expansion}-{event_type}-{format_date(day)}-{combine_splash}"
+                for day in days
+            ],
+            lambda indexes: download_color_ratings_many(
+                expansion,
+                event_type,
+                [(days[index], days[index]) for index in indexes],
+                combine_splash,
+            ),
+            [self.range_lifetime(day) for day in days],
+        )
+        ratings = [
+            data for data in map(day_color_ratings, ratings, days) if data is not None
+        ]
+        if not ratings:
+            return pl.DataFrame(schema={**COLOR_RATINGS_SCHEMA, "date": pl.Date})
+        return pl.concat(ratings, how="diagonal")
+
+    def get_summed_color_ratings(
+        self,
+        expansion: str,
+        event_type: str,
+        start_date: date,
+        end_date: date,
+        combine_splash: bool = False,
+    ) -> pl.DataFrame:
+        """Return color ratings for date range, see get_windowed_color_ratings"""
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        return self.get_windowed_color_ratings(
+            expansion,
+            event_type,
+            [end_date],
+            end_date - start_date + timedelta(days=1),
+            combine_splash,
+        ).drop("step")
+
+    def get_windowed_color_ratings(
+        self,
+        expansion: str,
+        event_type: str,
+        window_ends: List[date],
+        period: timedelta,
+        combine_splash: bool = False,
+    ) -> pl.DataFrame:
+        """Return color ratings over windows of period days ending at window_ends
+
+        Result has a row for each color with games in each window, labeled by
+        step column. With daily_ratings windows are summed from daily color
+        ratings, so overlapping windows share downloads, otherwise each window
+        is requested as a whole, which takes fewer requests on cold cache.
+        """
+        if not window_ends:
+            return pl.DataFrame(schema={"step": pl.Date, **COLOR_RATINGS_SCHEMA})
+        if self.daily_ratings:
+            daily = self.get_daily_color_ratings(
+                expansion,
+                event_type,
+                min(window_ends) - period + timedelta(days=1),
+                max(window_ends),
+                combine_splash,
+            )
+            return sum_color_ratings(daily, window_ends, period)
+        date_ranges = [
+            (window_end - period + timedelta(days=1), window_end)
+            for window_end in window_ends
+        ]
+        ratings = [
+            data.with_columns(pl.lit(window_end).cast(pl.Date).alias("step"))
+            for data, window_end in zip(
+                self.get_color_ratings_many(
+                    expansion, event_type, date_ranges, combine_splash
+                ),
+                window_ends,
             )
-            self.save()
-        return self._color_ratings[key].data
+        ]
+        return pl.concat(ratings, how="diagonal").filter(pl.col("games").is_not_null())
 
     def get_card_ratings(
         self,
@@ -117,17 +265,89 @@ class Storage:
         colors: Optional[str] = None,
     ) -> pl.DataFrame:
         """Return card ratings data from cache or download from 17lands if not found"""
-        self.purge()
         log.info("retrieving card ratings")
         key = f"{expansion}-{event_type}-{format_date(start_date)}-{format_date(end_date)}-{colors}"
-        if key not in self._card_ratings:
-            self._card_ratings[key] = StorageCell(
-                download_card_ratings(
-                    expansion, event_type, start_date, end_date, colors
+        return self._get(
+            "card_ratings",
+            key,
+            partial(
+                download_card_ratings,
+                expansion,
+                event_type,
+                start_date,
+                end_date,
+                colors,
+            ),
+            self.range_lifetime(end_date),
+        )
+
+    def get_daily_card_ratings(
+        self,
+        expansion: str,
+        event_type: str,
+        start_date: date,
+        end_date: date,
+        colors: Optional[str] = None,
+    ) -> pl.DataFrame:
+        """Return decomposed card ratings of every day from start_date to end_date inclusive
+
+        Each day is cached separately as additive sums, see decompose_card_ratings,
+        so only days not stored yet are downloaded. Settled days never expire.
+        """
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        days = [
+            start_date + timedelta(days=offset)
+            for offset in range((end_date - start_date).days + 1)
+        ]
+        log.info("retrieving daily card ratings for %d days", len(days))
+        ratings = self._get_many(
+            "card_ratings_daily",
+            [f"{expansion}-{event_type}-{format_date(day)}-{colors}" for day in days],
+            lambda indexes: [
+                data if isinstance(data, Exception) else decompose_card_ratings(data)
+                for data in download_card_ratings_many(
+                    expansion,
+                    event_type,
+                    [(days[index], days[index]) for index in indexes],
+                    colors,
                 )
+            ],
+            [self.range_lifetime(day) for day in days],
+        )
+        ratings = [
+            data.with_columns(pl.lit(day).alias("date"))
+            for data, day in zip(ratings, days)
+            if not data.is_empty()
+        ]
+        if not ratings:
+            return pl.DataFrame(schema={"name": pl.Utf8, "date": pl.Date})
+        return pl.concat(ratings, how="diagonal")
+
+    def get_summed_card_ratings(
+        self,
+        expansion: str,
+        event_type: str,
+        start_date: date,
+        end_date: date,
+        colors: Optional[str] = None,
+    ) -> pl.DataFrame:
+        """Return card ratings for date range
+
+        With daily_ratings they are composed from daily card ratings, otherwise
+        the range is requested as a whole, see get_card_ratings.
+        """
+        if not self.daily_ratings:
+            return self.get_card_ratings(
+                expansion, event_type, start_date, end_date, colors
+            )
+        return compose_card_ratings(
+            self.get_daily_card_ratings(
+                expansion, event_type, start_date, end_date, colors
             )
-            self.save()
-        return self._card_ratings[key].data
+        )
 
     def get_card_evaluation_metagame(
         self,
@@ -138,63 +358,165 @@ class Storage:
         start_date: date,
         end_date: date,
     ) -> pl.DataFrame:
-        """Return card evaluation metagame from cache or download from 17lands if not found"""
-        self.purge()
+        """Return card evaluation metagame from cache or download from 17lands if not found
+
+        Cards are identified by name, their images are in get_card_evaluation_cards.
+        """
         log.info("retrieving card evaluation metagame")
+        return self._get_card_evaluation(
+            "card_evaluation_metagame",
+            expansion,
+            event_type,
+            colors,
+            rarity,
+            start_date,
+            end_date,
+        )
+
+    def get_card_evaluation_cards(
+        self,
+        expansion: str,
+        event_type: str,
+        colors: str | None,
+        rarity: str | None,
+        start_date: date,
+        end_date: date,
+    ) -> pl.DataFrame:
+        """Return names and images of cards in card evaluation metagame"""
+        log.info("retrieving card evaluation cards")
+        return self._get_card_evaluation(
+            "card_evaluation_cards",
+            expansion,
+            event_type,
+            colors,
+            rarity,
+            start_date,
+            end_date,
+        )
+
+    def _get_card_evaluation(
+        self,
+        cache: str,
+        expansion: str,
+        event_type: str,
+        colors: str | None,
+        rarity: str | None,
+        start_date: date,
+        end_date: date,
+    ) -> pl.DataFrame:
         key = f"{expansion}-{event_type}-{colors}-{rarity}-{format_date(start_date)}-{format_date(end_date)}"
-        if key not in self._card_evaluation_metagame:
-            self._card_evaluation_metagame[key] = StorageCell(
-                download_card_evaluation_metagame(
-                    expansion, event_type, colors, rarity, start_date, end_date
+        lifetime = self.range_lifetime(end_date)
+
+        def download() -> pl.DataFrame:
+            # both tables come from one response, the one not asked for is
+            # cached right away too
+            tables = dict(
+                zip(
+                    ("card_evaluation_metagame", "card_evaluation_cards"),
+                    download_card_evaluation_metagame(
+                        expansion, event_type, colors, rarity, start_date, end_date
+                    ),
                 )
             )
-            self.save()
-        return self._card_evaluation_metagame[key].data
+            for other, data in tables.items():
+                if other != cache:
+                    with self._lock:
+                        self._store(other, key, data, lifetime)
+                    self._persist(other, [key])
+            return tables[cache]
+
+        return self._get(cache, key, download, lifetime)
 
     def get_play_draw(self) -> pl.DataFrame:
         """Return play/draw advantage data from cache or download from 17lands if not found"""
-        self.purge()
         log.info("retrieving play draw advantage")
-        if not self._play_draw:
-            self._play_draw = StorageCell(download_play_draw())
-            self.save()
-        return self._play_draw.data
-
-    def _find_first_day(self, expansion: str, event_type: str) -> Optional[date]:
-        start_date = beginning_date
-        end_date = datetime.now().date()
-        diff = end_date - start_date
-        ratings = storage.get_color_ratings(expansion, event_type, start_date, end_date)
-        if not ratings.filter(pl.col("color_name") == "All Decks")["games"][0]:
-            return None
-        while True:
-            ratings = storage.get_color_ratings(
-                expansion, event_type, start_date, end_date
-            )
-            diff = (diff / 2) + timedelta(hours=6)
-            if ratings.filter(pl.col("color_name") == "All Decks")["games"][0]:
-                if diff <= timedelta(days=1):
-                    return end_date
-                end_date -= diff
-            else:
-                if diff <= timedelta(days=1):
-                    return end_date + timedelta(days=1)
-                end_date += diff
+        return self._get("play_draw", "play_draw", download_play_draw)
 
     def get_first_day(self, expansion: str, event_type: str) -> Optional[date]:
-        """Return first day of format from cache or find it by downloading data from 17lands"""
-        self.purge()
+        """Return first day of format from first day table or cache
+
+        If it's not known, it's found by downloading data from 17lands and
+        added to first day table.
+        """
         log.info("retriving first day")
+        table = self.get_first_day_table()
+        found = table.filter(
+            (pl.col("expansion") == expansion) & (pl.col("event_type") == event_type)
+        )
+        if not found.is_empty():
+            return found["first_day"][0]
         key = f"{expansion}-{event_type}"
-        if key not in self._first_day:
-            first_day = self._find_first_day(expansion, event_type)
-            lifetime = timedelta(days=999) if first_day else timedelta(days=1)
-            self._first_day[key] = StorageCell(first_day, lifetime)
-            self.save()
-        return self._first_day[key].data
-
-
-try:
-    storage = Storage.load()
-except (OSError, pickle.UnpicklingError, ModuleNotFoundError):
-    storage = Storage()
+        first_day = self._get(
+            "first_day",
+            key,
+            partial(find_first_day, expansion, event_type),
+            lambda first_day: None if first_day else timedelta(days=1),
+        )
+        if first_day is not None:
+            self.update_first_day_table({(expansion, event_type): first_day})
+        return first_day
+
+    def get_first_day_table(self) -> pl.DataFrame:
+        """Return persisted table of first days found so far"""
+        cell = self._lookup("first_day_table", "table")
+        if cell is None:
+            return pl.DataFrame(schema=FIRST_DAY_TABLE_SCHEMA)
+        return cell.data
+
+    def update_first_day_table(
+        self, first_days: Dict[Tuple[str, str], date]
+    ) -> pl.DataFrame:
+        """Add first days of formats to persisted first day table"""
+        update = pl.DataFrame(
+            [
+                (expansion, event_type, first_day)
+                for (expansion, event_type), first_day in first_days.items()
+            ],
+            schema=FIRST_DAY_TABLE_SCHEMA,
+        )
+        previous = self.get_first_day_table()
+        with self._lock:
+            # table may have been updated by another thread since it was read
+            cell = self._caches["first_day_table"].get("table")
+            if cell is not None and cell.loaded:
+                previous = cell.data
+            table = pl.concat(
+                [
+                    previous.join(update, on=["expansion", "event_type"], how="anti"),
+                    update,
+                ]
+            )
+            self._store("first_day_table", "table", table, None)
+        self._persist("first_day_table", ["table"])
+        return table
+
+
+_config = {
+    "memory_budget": int(os.environ.get("RAGAVAN_MEMORY_BUDGET", DEFAULT_MEMORY_BUDGET))
+    or None,
+    "recent_lifetime": timedelta(
+        seconds=int(
+            os.environ.get(
+                "RAGAVAN_RECENT_LIFETIME", DEFAULT_RECENT_LIFETIME.total_seconds()
+            )
+        )
+    ),
+    "write_delay": timedelta(
+        seconds=float(
+            os.environ.get("RAGAVAN_WRITE_DELAY", DEFAULT_WRITE_DELAY.total_seconds())
+        )
+    )
+    or None,
+    "max_stale": timedelta(
+        seconds=float(
+            os.environ.get("RAGAVAN_MAX_STALE", DEFAULT_MAX_STALE.total_seconds())
+        )
+    )
+    or None,
+    "daily_ratings": bool(os.environ.get("RAGAVAN_DAILY_RATINGS")),
+}
+storage = Storage.load(
+    lazy=not os.environ.get("RAGAVAN_EAGER_LOAD"),
+    backend=backend_from_url(os.environ.get("RAGAVAN_CACHE_BACKEND")),
+    **_config,
+)
@@ -1,23 +1,38 @@
 """Card ratings graph component"""
 from datetime import datetime
 
-import polars as pl
-from dash import dcc, html
-from dash.dependencies import Input, Output
-from plotly import express as px
-from polars import col, lit
+from dash import Patch, dcc, html
+from dash.dependencies import ClientsideFunction, Input, Output
+from plotly import graph_objects as go
+from polars import col
 
 from ragavan.app import app
 from ragavan.common import (
     color_map,
     default_event_types,
     default_expansions,
+    format_date,
     optimal_date_range,
+    traces_by,
 )
+from ragavan.figure_cache import figure_cache
 from ragavan.first_day import get_first_day
 from ragavan.storage import storage
 
 
+def _figure() -> go.Figure:
+    """Create empty graph, traces are patched in by card_ratings_graph"""
+    fig = go.Figure()
+    fig.update_layout(
+        barmode="relative",
+        xaxis_title="normalized_gih",
+        yaxis={"title": "name", "categoryorder": "total ascending"},
+        legend_title="rarity",
+    )
+    fig.add_vline(x=0.5)
+    return fig
+
+
 def layout():
     """Create component"""
     filters = storage.get_filters()
@@ -75,24 +90,31 @@ def layout():
                     )
                 ],
             ),
-            html.Div(id="card-ratings-graph"),
+            dcc.Store(id="card-ratings-figure", data=_figure()),
+            html.Div(id="card-ratings-message"),
+            dcc.Graph(id="card-ratings-graph", style={"display": "none"}),
         ]
     )
 
 
 @app.callback(
-    Output("card-ratings-graph", "children"),
+    Output("card-ratings-figure", "data"),
+    Output("card-ratings-message", "children"),
     Input("card-ratings-expansion-input", "value"),
     Input("card-ratings-event-type-input", "value"),
     Input("card-ratings-date-range-input", "start_date"),
     Input("card-ratings-date-range-input", "end_date"),
     Input("card-ratings-colors-input", "value"),
-    Input("card-ratings-filter-input", "value"),
 )
-def card_ratings_graph(expansion, event_type, start_date, end_date, colors, filters):
-    """Re-generate graph when parameters change"""
+@figure_cache.memoize
+def card_ratings_graph(expansion, event_type, start_date, end_date, colors):
+    """Patch graph traces, range and height when data parameters change
+
+    Selected cards are highlighted in browser by highlight function in
+    assets/card_ratings.js.
+    """
     # fetch data
-    data = storage.get_card_ratings(
+    data = storage.get_summed_card_ratings(
         expansion,
         event_type,
         datetime.strptime(start_date, "%Y-%m-%d"),
@@ -107,10 +129,13 @@ def card_ratings_graph(expansion, event_type, start_date, end_date, colors, filt
         .sort("ever_drawn_win_rate")
     )
 
+    patch = Patch()
     if data.is_empty():
-        return "Not enough data"
+        patch["data"] = []
+        return (patch, "Not enough data")
 
     if colors:
+        # one ranged request, average doesn't need another daily series
         full_data = storage.get_card_ratings(
             expansion,
             event_type,
@@ -123,52 +148,62 @@ def card_ratings_graph(expansion, event_type, start_date, end_date, colors, filt
         global_avg = data["ever_drawn_win_rate"].mean()
     avg_diff = global_avg - 0.5
 
-    # normalize and format winrate
+    # normalize winrate
     data = data.with_columns(
-        col("ever_drawn_win_rate")
-        .apply(lambda x: max(x - avg_diff, 0))
-        .alias("normalized_gih")
-    ).with_columns(
-        col("normalized_gih").apply(lambda x: f"{x*100:.2f}%").alias("formatted_gih")
+        (col("ever_drawn_win_rate") - avg_diff).clip_min(0).alias("normalized_gih")
     )
 
     # calculate graph x range
-    height = len(data) * 16
     avg = data["normalized_gih"].mean()
     diff = data["normalized_gih"].tail(1)[0] - avg
-    x_min = avg - diff - 0.01
-    x_max = avg + diff + 0.01
+    patch["layout"]["xaxis"]["range"] = (avg - diff - 0.01, avg + diff + 0.01)
+    patch["layout"]["height"] = len(data) * 16
+
+    patch["data"] = traces_by(
+        data,
+        "rarity",
+        go.Bar,
+        {"y": "name", "x": "normalized_gih"},
+        color_map,
+        orientation="h",
+        texttemplate="%{x:.2%}",
+        textposition="outside",
+        textfont_size=12,
+        hovertemplate="<b>%{y}</b><br><br>gih=%{x:.2%}<extra></extra>",
+    ) + [
+        # legend entry, its color is used for highlighted bars
+        go.Bar(
+            name="selected",
+            x=[],
+            y=[],
+            orientation="h",
+            marker_color=color_map["selected"],
+        )
+    ]
+    return (patch, "")
 
-    # mark selected rows
-    data = data.with_columns(
-        pl.when(col("name").is_in(filters))
-        .then(lit("selected"))
-        .otherwise(col("rarity"))
-        .alias("rarity")
-    )
 
-    fig = px.bar(
-        data.to_pandas(),
-        y="name",
-        x="normalized_gih",
-        orientation="h",
-        color="rarity",
-        color_discrete_map=color_map,
-        range_x=(x_min, x_max),
-        text="formatted_gih",
-        hover_name="name",
-        hover_data={
-            "name": False,
-            "ever_drawn_win_rate": False,
-            "rarity": False,
-            "normalized_gih": False,
-            "formatted_gih": True,
-        },
+app.clientside_callback(
+    ClientsideFunction(namespace="card_ratings", function_name="highlight"),
+    Output("card-ratings-graph", "figure"),
+    Output("card-ratings-graph", "style"),
+    Input("card-ratings-figure", "data"),
+    Input("card-ratings-filter-input", "value"),
+)
+
+
+def warm_up():
+    """Build graph of default view into figure cache"""
+    expansion = default_expansions[0]
+    event_type = default_event_types[0]
+    start_date, end_date = optimal_date_range(get_first_day(expansion, event_type))
+    card_ratings_graph(
+        expansion,
+        event_type,
+        format_date(start_date),
+        format_date(end_date),
+        None,
     )
-    fig.update_layout(yaxis_categoryorder="total ascending", height=height)
-    fig.update_traces(textfont_size=12, textposition="outside")
-    fig.add_vline(x=0.5)
-    return dcc.Graph(figure=fig)
 
 
 @app.callback(
@@ -182,7 +217,7 @@ def update_controls(expansion, event_type):
     """Change controls values when selected format changes"""
     first_day = get_first_day(expansion, event_type)
     start_date, end_date = optimal_date_range(first_day)
-    data = storage.get_card_ratings(expansion, event_type, start_date, end_date)
+    data = storage.get_summed_card_ratings(expansion, event_type, start_date, end_date)
     names = list(data.get_column("name"))
     return (start_date, end_date, names)
 
@@ -1,7 +1,7 @@
 """Card ratings difference graph component"""
-from dash import dcc, html
+from dash import Patch, dcc, html, no_update
 from dash.dependencies import Input, Output
-from plotly import express as px
+from plotly import graph_objects as go
 from polars import col
 
 from ragavan.app import app
@@ -10,10 +10,21 @@ from ragavan.common import (
     default_event_types,
     default_expansions,
     parse_date,
+    traces_by,
 )
+from ragavan.figure_cache import figure_cache
 from ragavan.storage import storage
 
 
+def _figure() -> go.Figure:
+    """Create empty graph, traces are patched in by difference callbacks"""
+    fig = go.Figure()
+    fig.update_layout(
+        xaxis_title="alsa", yaxis_title="gih", legend_title="rarity", height=800
+    )
+    return fig
+
+
 def layout():
     """Create component"""
     return html.Div(
@@ -40,7 +51,14 @@ def layout():
                     html.Div(id="difference-controls-container"),
                 ],
             ),
-            html.Div(id="graph-container"),
+            html.Div(
+                id="graph-container",
+                children=dcc.Graph(
+                    id="card-ratings-difference-graph",
+                    figure=_figure(),
+                    style={"display": "none"},
+                ),
+            ),
         ]
     )
 
@@ -116,7 +134,8 @@ def difference_controls(difference: str):
 
 
 @app.callback(
-    Output("graph-container", "children", allow_duplicate=True),
+    Output("card-ratings-difference-graph", "figure", allow_duplicate=True),
+    Output("card-ratings-difference-graph", "style", allow_duplicate=True),
     Input("expansion-input", "value"),
     Input("event-input-common", "value"),
     Input("date-input-left", "start_date"),
@@ -125,6 +144,7 @@ def difference_controls(difference: str):
     Input("date-input-right", "end_date"),
     prevent_initial_call="initial_duplicate",
 )
+@figure_cache.memoize
 def graph_date_difference(
     expansion: str,
     event_type: str,
@@ -133,7 +153,7 @@ def graph_date_difference(
     right_start_date: str,
     right_end_date: str,
 ):
-    """Re-generate graph when parameters change"""
+    """Patch graph traces when parameters change"""
     if not all(
         [
             expansion,
@@ -144,16 +164,16 @@ def graph_date_difference(
             right_end_date,
         ]
     ):
-        return ""
+        return (no_update, {"display": "none"})
 
     left_start_date = parse_date(left_start_date)
     left_end_date = parse_date(left_end_date)
     right_start_date = parse_date(right_start_date)
     right_end_date = parse_date(right_end_date)
-    left_data = storage.get_card_ratings(
+    left_data = storage.get_summed_card_ratings(
         expansion, event_type, left_start_date, left_end_date
     )
-    right_data = storage.get_card_ratings(
+    right_data = storage.get_summed_card_ratings(
         expansion, event_type, right_start_date, right_end_date
     )
 
@@ -166,20 +186,21 @@ def graph_date_difference(
         )
     ).select("name", "alsa", "gih", "rarity")
 
-    fig = px.scatter(
-        difference_data.to_pandas(),
-        x="alsa",
-        y="gih",
-        height=800,
-        color_discrete_map=color_map,
-        hover_name="name",
-        color="rarity",
+    patch = Patch()
+    patch["data"] = traces_by(
+        difference_data,
+        "rarity",
+        go.Scatter,
+        {"x": "alsa", "y": "gih", "hovertext": "name"},
+        color_map,
+        mode="markers",
     )
-    return dcc.Graph(figure=fig)
+    return (patch, {})
 
 
 @app.callback(
-    Output("graph-container", "children", allow_duplicate=True),
+    Output("card-ratings-difference-graph", "figure", allow_duplicate=True),
+    Output("card-ratings-difference-graph", "style", allow_duplicate=True),
     Input("expansion-input", "value"),
     Input("date-input-common", "start_date"),
     Input("date-input-common", "end_date"),
@@ -187,6 +208,7 @@ def graph_date_difference(
     Input("event-input-right", "value"),
     prevent_initial_call="initial_duplicate",
 )
+@figure_cache.memoize
 def graph_format_difference(
     expansion: str,
     start_date: str,
@@ -194,7 +216,7 @@ def graph_format_difference(
     left_event_type: str,
     right_event_type: str,
 ):
-    """Re-generate graph when parameters change"""
+    """Patch graph traces when parameters change"""
     if not all(
         [
             expansion,
@@ -204,14 +226,14 @@ def graph_format_difference(
             right_event_type,
         ]
     ):
-        return ""
+        return (no_update, {"display": "none"})
 
     start_date = parse_date(start_date)
     end_date = parse_date(end_date)
-    left_data = storage.get_card_ratings(
+    left_data = storage.get_summed_card_ratings(
         expansion, left_event_type, start_date, end_date
     )
-    right_data = storage.get_card_ratings(
+    right_data = storage.get_summed_card_ratings(
         expansion, right_event_type, start_date, end_date
     )
 
@@ -224,13 +246,13 @@ def graph_format_difference(
         )
     ).select("name", "alsa", "gih", "rarity")
 
-    fig = px.scatter(
-        difference_data.to_pandas(),
-        x="alsa",
-        y="gih",
-        height=800,
-        color_discrete_map=color_map,
-        hover_name="name",
-        color="rarity",
+    patch = Patch()
+    patch["data"] = traces_by(
+        difference_data,
+        "rarity",
+        go.Scatter,
+        {"x": "alsa", "y": "gih", "hovertext": "name"},
+        color_map,
+        mode="markers",
     )
-    return dcc.Graph(figure=fig)
+    return (patch, {})
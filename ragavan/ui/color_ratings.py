@@ -1,9 +1,9 @@
 """Color ratings graph component"""
 from datetime import datetime
 
-from dash import dcc, html
+from dash import Patch, dcc, html
 from dash.dependencies import Input, Output
-from plotly import express as px
+from plotly import graph_objects as go
 from polars import col, concat, lit
 
 from ragavan.app import app
@@ -11,12 +11,28 @@ from ragavan.common import (
     color_pairs_full,
     default_event_types,
     default_expansions,
+    format_date,
     optimal_date_range,
+    traces_by,
 )
+from ragavan.figure_cache import figure_cache
 from ragavan.first_day import get_first_day
 from ragavan.storage import storage
 
 
+def _figure() -> go.Figure:
+    """Create empty graph, traces are patched in by color_ratings_graph"""
+    fig = go.Figure()
+    fig.update_layout(
+        barmode="group",
+        xaxis_title="color_name",
+        yaxis_title="winrate",
+        legend_title="event_type",
+        height=800,
+    )
+    return fig
+
+
 def layout():
     """Create component"""
     expansion = default_expansions[0]
@@ -63,27 +79,30 @@ def layout():
                     ),
                 ],
             ),
-            html.Div(id="color-ratings-graph"),
+            html.Div(id="color-ratings-message"),
+            dcc.Graph(id="color-ratings-graph", figure=_figure()),
         ]
     )
 
 
 @app.callback(
-    Output("color-ratings-graph", "children"),
+    Output("color-ratings-graph", "figure"),
+    Output("color-ratings-message", "children"),
     Input("color-ratings-expansion-input", "value"),
     Input("color-ratings-event-type-input", "value"),
     Input("color-ratings-date-range-input", "start_date"),
     Input("color-ratings-date-range-input", "end_date"),
     Input("color-ratings-combine-splash-input", "value"),
 )
+@figure_cache.memoize
 def color_ratings_graph(expansion, event_type, start_date, end_date, combine_splash):
-    """Re-generate graph when parameters change"""
+    """Patch graph traces and range when parameters change"""
     start_date = datetime.strptime(start_date, "%Y-%m-%d")
     end_date = datetime.strptime(end_date, "%Y-%m-%d")
     only_pairs = combine_splash == "Only Pairs"
     splash = combine_splash != "Separate Splash"
     data = [
-        storage.get_color_ratings(
+        storage.get_summed_color_ratings(
             expansion, event, start_date, end_date, splash
         ).with_columns(lit(event).alias("event_type"))
         for event in event_type
@@ -92,21 +111,33 @@ def color_ratings_graph(expansion, event_type, start_date, end_date, combine_spl
     if only_pairs:
         data = data.filter(col("color_name").is_in(color_pairs_full))
     data = data.with_columns((col("wins") / col("games")).alias("winrate"))
+    patch = Patch()
     if data.is_empty():
-        return "Not enough data"
-    min_y = data["winrate"].min() - 0.01
-    max_y = data["winrate"].max() + 0.01
-    data = data.to_pandas()
-    fig = px.bar(
-        data,
-        x="color_name",
-        y="winrate",
-        color="event_type",
-        barmode="group",
-        height=800,
-        range_y=(min_y, max_y),
+        patch["data"] = []
+        return (patch, "Not enough data")
+    patch["data"] = traces_by(
+        data, "event_type", go.Bar, {"x": "color_name", "y": "winrate"}
+    )
+    patch["layout"]["yaxis"]["range"] = (
+        data["winrate"].min() - 0.01,
+        data["winrate"].max() + 0.01,
+    )
+    return (patch, "")
+
+
+def warm_up():
+    """Build graph of default view into figure cache"""
+    expansion = default_expansions[0]
+    start_date, end_date = optimal_date_range(
+        get_first_day(expansion, default_event_types[0])
+    )
+    color_ratings_graph(
+        expansion,
+        default_event_types[:1],
+        format_date(start_date),
+        format_date(end_date),
+        "Only Pairs",
     )
-    return dcc.Graph(figure=fig)
 
 
 @app.callback(
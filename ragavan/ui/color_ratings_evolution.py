@@ -1,10 +1,10 @@
 """Color ratings evolution graph component"""
 from datetime import datetime, timedelta
 
-from dash import dcc, html
+from dash import Patch, dcc, html
 from dash.dependencies import Input, Output
-from plotly import express as px
-from polars import Boolean, col, concat, lit
+from plotly import graph_objects as go
+from polars import col
 
 from ragavan.app import app
 from ragavan.common import (
@@ -13,11 +13,26 @@ from ragavan.common import (
     default_event_types,
     default_expansions,
     optimal_date_range,
+    traces_by,
 )
+from ragavan.figure_cache import figure_cache
 from ragavan.first_day import get_first_day
 from ragavan.storage import storage
 
 
+def _figure() -> go.Figure:
+    """Create empty graph, traces are patched in by color_ratings_graph"""
+    fig = go.Figure()
+    fig.update_layout(
+        height=800,
+        plot_bgcolor="#262321",
+        yaxis={"title": "winrate", "gridcolor": "#5A5652"},
+        xaxis={"title": "step", "gridcolor": "#5A5652"},
+        legend_title="color_name",
+    )
+    return fig
+
+
 def layout():
     """Create component"""
     expansion = default_expansions[0]
@@ -61,7 +76,7 @@ def layout():
                     dcc.Dropdown(
                         id="color-ratings-evolution-step-input",
                         className="dropdown",
-                        options=["2 days", "week"],
+                        options=["2 days", "week", "rolling week"],
                         value="week",
                         searchable=False,
                         clearable=False,
@@ -74,13 +89,15 @@ def layout():
                     ),
                 ],
             ),
-            html.Div(id="color-ratings-evolution-graph"),
+            html.Div(id="color-ratings-evolution-message"),
+            dcc.Graph(id="color-ratings-evolution-graph", figure=_figure()),
         ]
     )
 
 
 @app.callback(
-    Output("color-ratings-evolution-graph", "children"),
+    Output("color-ratings-evolution-graph", "figure"),
+    Output("color-ratings-evolution-message", "children"),
     Input("color-ratings-evolution-expansion-input", "value"),
     Input("color-ratings-evolution-event-type-input", "value"),
     Input("color-ratings-evolution-date-range-input", "start_date"),
@@ -88,50 +105,48 @@ def layout():
     Input("color-ratings-evolution-combine-splash-input", "value"),
     Input("color-ratings-evolution-step-input", "value"),
 )
+@figure_cache.memoize
 def color_ratings_graph(
     expansion, event_type, start_date, end_date, combine_splash, step
 ):
-    """Re-generate graph when parameters change"""
+    """Patch graph traces and range when parameters change"""
     start_date = datetime.strptime(start_date, "%Y-%m-%d")
     end_date = datetime.strptime(end_date, "%Y-%m-%d")
     only_pairs = combine_splash == "Only Pairs"
     splash = combine_splash != "Separate Splash"
 
-    data = []
-    step = timedelta(days=2) if step == "2 days" else timedelta(weeks=1)
-    while start_date + step < end_date:
-        step_data = storage.get_color_ratings(
-            expansion, event_type, start_date, start_date + step, splash
-        ).with_columns(lit(start_date + step).alias("step"))
-        if step_data.schema["wins"] != Boolean:
-            data.append(step_data)
-        start_date += step
-    data = concat(data)
+    period = timedelta(days=2) if step == "2 days" else timedelta(weeks=1)
+    every = timedelta(days=1) if step == "rolling week" else period
+    window_ends = []
+    window_end = start_date.date() + period - timedelta(days=1)
+    while window_end < end_date.date():
+        window_ends.append(window_end)
+        window_end += every
+    data = storage.get_windowed_color_ratings(
+        expansion, event_type, window_ends, period, splash
+    )
     if only_pairs:
         data = data.filter(col("color_name").is_in(color_pairs_full))
     data = data.with_columns((col("wins") / col("games")).alias("winrate"))
+    patch = Patch()
     if data.is_empty():
-        return "Not enough data"
-    min_y = data["winrate"].min() - 0.01
-    max_y = data["winrate"].max() + 0.01
-    data = data.to_pandas()
-
-    fig = px.line(
+        patch["data"] = []
+        return (patch, "Not enough data")
+    patch["data"] = traces_by(
         data,
-        x="step",
-        y="winrate",
-        color="color_name",
-        height=800,
-        color_discrete_map=color_pairs_color_map,
+        "color_name",
+        go.Scatter,
+        {"x": "step", "y": "winrate"},
+        color_pairs_color_map,
+        color_property="line_color",
+        mode="lines",
         line_shape="spline",
-        range_y=(min_y, max_y),
     )
-    fig.update_layout(
-        plot_bgcolor="#262321",
-        yaxis={"gridcolor": "#5A5652"},
-        xaxis={"gridcolor": "#5A5652"},
+    patch["layout"]["yaxis"]["range"] = (
+        data["winrate"].min() - 0.01,
+        data["winrate"].max() + 0.01,
     )
-    return dcc.Graph(figure=fig)
+    return (patch, "")
 
 
 @app.callback(
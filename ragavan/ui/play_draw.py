@@ -1,7 +1,7 @@
 """Play/draw advantage graph component"""
-from dash import dcc, html
+from dash import Patch, dcc, html
 from dash.dependencies import Input, Output
-from plotly import express as px
+from plotly import graph_objects as go
 from polars import col
 
 from ragavan.app import app
@@ -10,10 +10,24 @@ from ragavan.common import (
     default_expansions,
     default_selected_event_types,
     default_selected_expansions,
+    traces_by,
 )
+from ragavan.figure_cache import figure_cache
 from ragavan.storage import storage
 
 
+def _figure() -> go.Figure:
+    """Create empty graph, traces are patched in by play_draw_graph"""
+    fig = go.Figure()
+    fig.update_layout(
+        xaxis_title="win_rate_on_play",
+        yaxis_title="average_game_length",
+        legend_title="event_type",
+        height=800,
+    )
+    return fig
+
+
 def layout():
     """Create component"""
     return html.Div(
@@ -41,33 +55,42 @@ def layout():
                 ],
                 className="controls-container",
             ),
-            html.Div(id="play-draw-graph", className="graph-container"),
+            html.Div(
+                className="graph-container",
+                children=dcc.Graph(id="play-draw-graph", figure=_figure()),
+            ),
         ],
         className="app-container",
     )
 
 
 @app.callback(
-    Output("play-draw-graph", "children"),
+    Output("play-draw-graph", "figure"),
     Input("play-draw-expansions-input", "value"),
     Input("play-draw-event-types-input", "value"),
 )
+@figure_cache.memoize
 def play_draw_graph(expansions, event_types):
-    """Re-generate graph when parameters change"""
+    """Patch graph traces when parameters change"""
     data = storage.get_play_draw()
     data = data.filter(
         col("expansion").is_in(expansions) & col("event_type").is_in(event_types)
     )
-    fig = px.scatter(
-        data.to_pandas(),
-        x="win_rate_on_play",
-        y="average_game_length",
-        text="expansion",
-        color="event_type",
-        height=800,
+    patch = Patch()
+    patch["data"] = traces_by(
+        data,
+        "event_type",
+        go.Scatter,
+        {"x": "win_rate_on_play", "y": "average_game_length", "text": "expansion"},
+        mode="markers+text",
+        textposition="top right",
     )
-    fig.update_traces(textposition="top right")
-    return dcc.Graph(figure=fig)
+    return patch
+
+
+def warm_up():
+    """Build graph of default view into figure cache"""
+    play_draw_graph(default_selected_expansions, default_selected_event_types)
 
 
 @app.callback(